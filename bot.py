@@ -1,53 +1,768 @@
 # Telegram Bot - Simple Event Reporting
 import os
+import sys
 import time
 import json
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import threading
+import queue
+import gzip
+import shutil
+import atexit
+import sqlite3
 import traceback
 import datetime
+import hashlib
+import hmac
+import tempfile
+import bisect
+import asyncio
+import functools
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from html import escape
 from flask import Flask, request
 from dotenv import load_dotenv
 
+try:
+    import aiohttp
+    import aiohttp.web
+except ImportError:  # нужен только для BOT_MODE=async
+    aiohttp = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: ротацию логов не сериализуем между процессами
+    fcntl = None
+
+# Момент начала импорта — для замера холодного старта
+BOOT_STARTED = time.monotonic()
+
 # Загружаем переменные окружения
 load_dotenv()
 
+# ====== Метрики ======
+# Границы корзин гистограмм задержки, сек
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Metric:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fmt_labels(names, values, extra=""):
+        parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+class CounterMetric(_Metric):
+    """Монотонный счётчик. Запись — одна короткая критическая секция."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name + self._fmt_labels(self.labels, k), v) for k, v in items]
+
+class HistogramMetric(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [счётчики по корзинам..., +Inf, sum]
+
+    def observe(self, value, *label_values):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[idx] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._series.items()]
+        out = []
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                out.append((self.name + "_bucket" + self._fmt_labels(self.labels, labels, f'le="{bound}"'), cumulative))
+            out.append((self.name + "_sum" + self._fmt_labels(self.labels, labels), round(series[-1], 6)))
+            out.append((self.name + "_count" + self._fmt_labels(self.labels, labels), cumulative))
+        return out
+
+class CallbackMetric(_Metric):
+    """Значение вычисляется только при чтении /metrics (нулевая цена на горячем пути).
+
+    ``fn`` возвращает число или словарь {кортеж значений меток: число}.
+    """
+
+    def __init__(self, name, help_text, fn, labels=(), kind="gauge"):
+        super().__init__(name, help_text, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            return [(self.name + self._fmt_labels(self.labels, k), v) for k, v in value.items()]
+        return [(self.name, value)]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(CounterMetric(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(HistogramMetric(name, help_text, labels, buckets))
+
+    def gauge_func(self, name, help_text, fn, labels=(), kind="gauge"):
+        return self.register(CallbackMetric(name, help_text, fn, labels, kind))
+
+    def render(self):
+        """Текст в формате Prometheus exposition 0.0.4"""
+        lines = []
+        for m in self._metrics:
+            try:
+                samples = m.samples()
+            except Exception as e:
+                lines.append(f"# {m.name} unavailable: {type(e).__name__}")
+                continue
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for key, value in samples:
+                lines.append(f"{key} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+UPDATE_LATENCY = metrics.histogram(
+    "bot_update_duration_seconds", "Обработка одного update по типу", ("kind",))
+WEBHOOK_LATENCY = metrics.histogram(
+    "bot_webhook_request_seconds", "Время ответа маршрута /webhook")
+API_LATENCY = metrics.histogram(
+    "telegram_api_request_seconds", "Запросы к Bot API по методу и HTTP-статусу", ("method", "status"))
+ERRORS_TOTAL = metrics.counter(
+    "bot_errors_total", "Ошибки, прошедшие через cool_error_handler", ("type",))
+
+# ====== Трассировка и профилирование ======
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "0").strip() == "1"
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles").strip()
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_ON_START = float(os.getenv("PROFILE_ON_START", "0"))
+
+_trace_local = threading.local()
+
+class UpdateTrace:
+    """Спаны одного update: декодирование, обработка и каждый исходящий вызов.
+
+    Трасса следует за update через потоки диспетчера и outbox: каждый этап
+    берёт её через hold() и отпускает release(). Когда отпущен последний этап,
+    трасса длиннее TRACE_SLOW_MS попадает в лог.
+    """
+
+    __slots__ = ('update_id', 'started', 'spans', '_pending', '_lock')
+
+    def __init__(self, update_id=None):
+        self.update_id = update_id
+        self.started = time.perf_counter()
+        self.spans = []
+        self._pending = 1
+        self._lock = threading.Lock()
+
+    def hold(self):
+        with self._lock:
+            self._pending += 1
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+            done = self._pending == 0
+        if done:
+            self._finish()
+
+    def _finish(self):
+        total_ms = (time.perf_counter() - self.started) * 1000
+        if total_ms < TRACE_SLOW_MS:
+            return
+        spans = ", ".join(f"{name}@{start * 1000:.0f}+{dur * 1000:.1f}ms" for name, start, dur in self.spans)
+        MainProtokol(f"update {self.update_id}: {total_ms:.1f} ms [{spans}]", ts='SLOW')
+
+class _Span:
+    __slots__ = ('trace', 'name', 't0')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        t1 = time.perf_counter()
+        self.trace.spans.append((self.name, self.t0 - self.trace.started, t1 - self.t0))
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def current_trace():
+    return getattr(_trace_local, 'trace', None)
+
+def trace_span(name):
+    """Контекст-менеджер спана текущей трассы; без трассы — общий пустой объект."""
+    trace = getattr(_trace_local, 'trace', None)
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, name)
+
+@contextmanager
+def use_trace(trace):
+    """Делает ``trace`` текущей для потока на время выполнения этапа."""
+    previous = getattr(_trace_local, 'trace', None)
+    _trace_local.trace = trace
+    try:
+        yield
+    finally:
+        _trace_local.trace = previous
+        trace.release()
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер всех потоков через sys._current_frames().
+
+    Раз в PROFILE_INTERVAL снимает стеки и по окончании окна пишет их
+    в формате collapsed stacks (flamegraph.pl / speedscope) в PROFILE_DIR.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = False
+
+    def start(self, seconds):
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+        threading.Thread(target=self._run, args=(seconds,), name="profiler", daemon=True).start()
+        return True
+
+    def _run(self, seconds):
+        stacks = {}
+        own = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    parts = []
+                    while frame is not None:
+                        code = frame.f_code
+                        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        frame = frame.f_back
+                    if ident not in names:
+                        names = {t.ident: t.name for t in threading.enumerate()}
+                    key = names.get(ident, str(ident)) + ";" + ";".join(reversed(parts))
+                    stacks[key] = stacks.get(key, 0) + 1
+                time.sleep(PROFILE_INTERVAL)
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S.collapsed"))
+            with open(path, 'w', encoding='utf-8') as f:
+                for key, count in sorted(stacks.items(), key=lambda kv: -kv[1]):
+                    f.write(f"{key} {count}\n")
+            MainProtokol(f"Профіль за {seconds} с збережено: {path}")
+        except Exception as e:
+            cool_error_handler(e, context="SamplingProfiler")
+        finally:
+            with self._lock:
+                self.running = False
+
+profiler = SamplingProfiler()
+
 # ====== Логирование ======
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_ROTATE_INTERVAL = float(os.getenv("LOG_ROTATE_INTERVAL", "86400"))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_FLUSH_BYTES = int(os.getenv("LOG_FLUSH_BYTES", str(64 * 1024)))
+
+class AsyncLogWriter:
+    """Фоновая запись в лог-файл.
+
+    write() только кладёт строку в очередь; поток-писатель сбрасывает накопленное
+    на диск пачкой (по объёму LOG_FLUSH_BYTES или раз в LOG_FLUSH_INTERVAL сек),
+    ротирует файл по размеру/времени и сжимает старые сегменты в .gz.
+    При переполнении очереди записи отбрасываются и учитываются в ``dropped``.
+
+    Файл общий для всех воркеров gunicorn: начало текущего сегмента хранится
+    в ``<path>.rotate``, а ротация идёт под flock на этом файле с повторной
+    проверкой — сегмент ротирует ровно один процесс.
+    """
+
+    _STOP = object()
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, rotate_interval=LOG_ROTATE_INTERVAL,
+                 backup_count=LOG_BACKUP_COUNT, max_queue=LOG_QUEUE_MAX):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._segment_started = None  # кэш содержимого <path>.rotate
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _ensure_started(self):
+        # После fork (gunicorn) поток родителя в дочернем процессе не существует
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.SimpleQueue()
+            self._thread = threading.Thread(target=self._run, name=f"log-{self.path}", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def write(self, text):
+        self._ensure_started()
+        if self._queue.qsize() >= self.max_queue:
+            self.dropped += 1
+            return
+        self._queue.put(text)
+
+    def close(self, timeout=2.0):
+        """Сбрасывает очередь на диск (вызывается при выходе)."""
+        if self._pid != os.getpid():
+            return
+        done = threading.Event()
+        self._queue.put((self._STOP, done))
+        done.wait(timeout)
+
+    def _run(self):
+        q = self._queue
+        buf = []
+        size = 0
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while True:
+            stop = None
+            try:
+                item = q.get(timeout=max(deadline - time.monotonic(), 0.01))
+                if isinstance(item, tuple) and item and item[0] is self._STOP:
+                    stop = item[1]
+                else:
+                    buf.append(item)
+                    size += len(item)
+            except queue.Empty:
+                pass
+            if buf and (stop or size >= LOG_FLUSH_BYTES or time.monotonic() >= deadline):
+                self._flush(buf)
+                buf = []
+                size = 0
+            if time.monotonic() >= deadline or not buf:
+                deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            if stop:
+                stop.set()
+
+    def _flush(self, chunks):
+        if self.dropped != self._reported_dropped:
+            chunks.append(f"{time.strftime('%d.%m.%Y %H:%M:')}00;WARN;Черга логу переповнена, втрачено записів: {self.dropped - self._reported_dropped}\n")
+            self._reported_dropped = self.dropped
+        # Неудачная ротация не должна стоить пачки записей
+        try:
+            self._maybe_rotate()
+        except Exception as e:
+            print("Ошибка ротации лога:", e)
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(chunks))
+        except Exception as e:
+            print("Ошибка записи в лог:", e)
+
+    def _rotation_due(self, size, started):
+        expired = self.rotate_interval and time.time() - started >= self.rotate_interval
+        return size >= self.max_bytes or (expired and size > 0)
+
+    @staticmethod
+    def _read_segment_start(marker):
+        marker.seek(0)
+        try:
+            return float(marker.read().strip())
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _write_segment_start(marker, started):
+        marker.seek(0)
+        marker.truncate()
+        marker.write(repr(started))
+        marker.flush()
+
+    def _maybe_rotate(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if self._segment_started is not None and not self._rotation_due(size, self._segment_started):
+            return
+        with open(self.path + '.rotate', 'a+', encoding='utf-8') as marker:
+            if fcntl is not None:
+                fcntl.flock(marker, fcntl.LOCK_EX)
+            # Под блокировкой перечитываем состояние: сегмент мог ротировать другой воркер
+            started = self._read_segment_start(marker)
+            if started is None:
+                started = time.time()
+                self._write_segment_start(marker, started)
+            self._segment_started = started
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                return
+            if not self._rotation_due(size, started):
+                return
+            rotated = f"{self.path}.{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+            os.replace(self.path, rotated)
+            self._segment_started = time.time()
+            self._write_segment_start(marker, self._segment_started)
+        with open(rotated, 'rb') as src, gzip.open(rotated + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(rotated)
+        base = os.path.basename(self.path) + '.'
+        directory = os.path.dirname(self.path) or '.'
+        old = sorted(n for n in os.listdir(directory) if n.startswith(base) and n.endswith('.gz'))
+        for name in old[:-self.backup_count] if self.backup_count else old:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass  # удалил другой воркер
+
+main_log = AsyncLogWriter('log.txt')
+error_log = AsyncLogWriter('critical_errors.log')
+atexit.register(main_log.close)
+atexit.register(error_log.close)
+
 def MainProtokol(s, ts='Запис'):
     dt = time.strftime('%d.%m.%Y %H:%M:') + '00'
-    try:
-        with open('log.txt', 'a', encoding='utf-8') as f:
-            f.write(f"{dt};{ts};{s}\n")
-    except Exception as e:
-        print("Ошибка записи в лог:", e)
+    main_log.write(f"{dt};{ts};{s}\n")
 
 # ====== Обработчик ошибок ======
+# Полный traceback пишется для первого и каждого ERROR_SAMPLE_EVERY-го повторения (0 — только для первого)
+ERROR_SAMPLE_EVERY = int(os.getenv("ERROR_SAMPLE_EVERY", "100"))
+ERROR_SUMMARY_INTERVAL = float(os.getenv("ERROR_SUMMARY_INTERVAL", "300"))
+ERROR_ALERT_ADMIN = os.getenv("ERROR_ALERT_ADMIN", "0").strip() == "1"
+ERROR_ALERT_INTERVAL = float(os.getenv("ERROR_ALERT_INTERVAL", "600"))
+
+class ErrorAggregator:
+    """Группирует ошибки по отпечатку (тип исключения + кадры стека).
+
+    Для каждого отпечатка считает повторения; фоновый поток раз в
+    ERROR_SUMMARY_INTERVAL пишет сводку по отпечаткам, которые повторялись
+    с прошлой сводки (в том числе после того, как ошибки прекратились).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}  # отпечаток -> [всего, на момент прошлой сводки, тип, контекст]
+        self._last_alert = {}
+        self._pid = None
+
+    def _ensure_started(self):
+        # Поток стартует при первой ошибке (и заново после fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._summary_loop, name="error-summary", daemon=True).start()
+
+    def _summary_loop(self):
+        while True:
+            time.sleep(ERROR_SUMMARY_INTERVAL)
+            try:
+                self.write_summary()
+            except Exception as e:
+                print("Ошибка записи сводки ошибок:", e)
+
+    def should_sample(self, count):
+        """Писать ли полный traceback для count-го повторения."""
+        return count == 1 or (ERROR_SAMPLE_EVERY > 0 and count % ERROR_SAMPLE_EVERY == 0)
+
+    @staticmethod
+    def fingerprint(exc):
+        frames = traceback.extract_tb(exc.__traceback__)
+        key = type(exc).__qualname__ + "|" + "|".join(
+            f"{os.path.basename(f.filename)}:{f.name}:{f.lineno}" for f in frames)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+    def record(self, exc, context):
+        """Возвращает (отпечаток, номер повторения)."""
+        self._ensure_started()
+        fp = self.fingerprint(exc)
+        with self._lock:
+            entry = self._stats.get(fp)
+            if entry is None:
+                entry = self._stats[fp] = [0, 0, type(exc).__name__, context]
+            entry[0] += 1
+            return fp, entry[0]
+
+    def summary(self):
+        """Строки сводки по отпечаткам, повторявшимся с прошлого вызова."""
+        with self._lock:
+            lines = []
+            for fp, entry in self._stats.items():
+                if entry[0] != entry[1]:
+                    lines.append(f"{fp} {entry[2]} [{entry[3]}]: +{entry[0] - entry[1]} (усього {entry[0]})")
+                    entry[1] = entry[0]
+        return lines
+
+    def write_summary(self):
+        lines = self.summary()
+        if lines:
+            ts = time.strftime('%Y-%m-%d %H:%M:%S')
+            text = "".join(f"{ts};SUMMARY;{line}\n" for line in lines)
+            error_log.write(text)
+            print(text, end="")
+
+    def alert_allowed(self, fp):
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_alert.get(fp)
+            if last is not None and now - last < ERROR_ALERT_INTERVAL:
+                return False
+            self._last_alert[fp] = now
+            return True
+
+error_stats = ErrorAggregator()
+
+def _alert_admin(text):
+    try:
+        if ADMIN_ID:
+            outbox.submit(ADMIN_ID, send_message, ADMIN_ID, text)
+    except NameError:
+        # Ошибка при импорте модуля — отправлять ещё нечем
+        pass
+
 def cool_error_handler(exc, context="", send_to_telegram=False):
     exc_type = type(exc).__name__
-    tb_str = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+    ERRORS_TOTAL.inc(exc_type)
+    fp, count = error_stats.record(exc, context)
     ts = time.strftime('%Y-%m-%d %H:%M:%S')
-    readable_msg = (
-        "\n" + "=" * 40 + "\n"
-        f"[ERROR] {exc_type}\n"
-        f"Context: {context}\n"
-        f"Time: {ts}\n"
-        "Traceback:\n"
-        f"{tb_str}"
-        + "=" * 40 + "\n"
-    )
-    try:
-        with open('critical_errors.log', 'a', encoding='utf-8') as f:
-            f.write(readable_msg)
-    except Exception as write_err:
-        print("Не удалось записать в 'critical_errors.log':", write_err)
-    print(readable_msg)
-
-# ====== Фоновый отладчик времени ======
-def time_debugger():
-    while True:
-        print("[DEBUG]", time.strftime('%Y-%m-%d %H:%M:%S'))
-        time.sleep(300)
+    if error_stats.should_sample(count):
+        tb_str = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        readable_msg = (
+            "\n" + "=" * 40 + "\n"
+            f"[ERROR] {exc_type}\n"
+            f"Context: {context}\n"
+            f"Time: {ts}\n"
+            f"Fingerprint: {fp} (#{count})\n"
+            "Traceback:\n"
+            f"{tb_str}"
+            + "=" * 40 + "\n"
+        )
+        error_log.write(readable_msg)
+        print(readable_msg)
+
+    if (send_to_telegram or ERROR_ALERT_ADMIN) and error_stats.alert_allowed(fp):
+        _alert_admin(f"⚠️ {exc_type} у {context} (#{count}, {fp}): {str(exc)[:300]}")
+
+# ====== Сторожевой таймер зависаний ======
+WATCHDOG_INTERVAL = float(os.getenv("WATCHDOG_INTERVAL", "1.0"))
+WATCHDOG_DEADLINE = float(os.getenv("WATCHDOG_DEADLINE", "5"))            # обработка одного update
+WATCHDOG_OUTBOX_DEADLINE = float(os.getenv("WATCHDOG_OUTBOX_DEADLINE", "60"))  # исходящий вызов с ожиданием лимитов
+WATCHDOG_UNHEALTHY_AFTER = float(os.getenv("WATCHDOG_UNHEALTHY_AFTER", "120"))
+
+class StallWatchdog:
+    """Следит за выполняющимися заданиями (обработка update, задания outbox, event loop).
+
+    Обработчики регистрируют начало и конец работы через begin()/end().
+    Фоновый поток раз в WATCHDOG_INTERVAL ищет задания дольше их дедлайна
+    и пишет стек зависшего потока (sys._current_frames) в critical_errors.log —
+    по одному разу на задание. Ожидание лимитов Telegram (блок waiting(): паузы
+    ограничителя и retry_after после 429) во время работы не засчитывается.
+    Экземпляр считается нездоровым, если какое-то задание превысило свой
+    дедлайн больше чем на WATCHDOG_UNHEALTHY_AFTER или сам сторож перестал работать.
+    """
+
+    def __init__(self, interval=WATCHDOG_INTERVAL, unhealthy_after=WATCHDOG_UNHEALTHY_AFTER):
+        self.interval = interval
+        self.unhealthy_after = unhealthy_after
+        self._lock = threading.Lock()
+        self._inflight = {}  # token -> [thread_id, метка, начало, дедлайн, уже сообщено, ожидание, начало ожидания]
+        self._local = threading.local()
+        self._next_token = 0
+        self._pid = None
+        self._last_tick = time.monotonic()
+        self._loop_thread = None
+        self._loop_beat = None
+        self._loop_reported = False
+        self.stalls = 0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._inflight = {}
+            self._last_tick = time.monotonic()
+            threading.Thread(target=self._run, name="watchdog", daemon=True).start()
+            self._pid = os.getpid()
+
+    def start(self):
+        self._ensure_started()
+
+    def begin(self, label, deadline=WATCHDOG_DEADLINE):
+        self._ensure_started()
+        with self._lock:
+            self._next_token += 1
+            token = self._next_token
+            self._inflight[token] = [threading.get_ident(), label, time.monotonic(), deadline, False, 0.0, None]
+        self._local.token = token
+        return token
+
+    def end(self, token):
+        self._local.token = None
+        with self._lock:
+            entry = self._inflight.pop(token, None)
+        if entry and entry[4]:
+            MainProtokol(f"{entry[1]}: завершено через {time.monotonic() - entry[2]:.1f} с після зависання", ts='WARN')
+
+    @contextmanager
+    def waiting(self):
+        """Плановое ожидание текущего задания (лимиты Bot API) — не считается зависанием."""
+        token = getattr(self._local, 'token', None)
+        with self._lock:
+            entry = self._inflight.get(token)
+            if entry is not None:
+                entry[6] = time.monotonic()
+        try:
+            yield
+        finally:
+            if entry is not None:
+                with self._lock:
+                    entry[5] += time.monotonic() - entry[6]
+                    entry[6] = None
+
+    @staticmethod
+    def _active(entry, now):
+        """Время работы задания без плановых ожиданий."""
+        waited = entry[5] + (now - entry[6] if entry[6] is not None else 0.0)
+        return now - entry[2] - waited
+
+    def watch_loop(self):
+        """Вызывается внутри event loop: корутина-пульс, отставание которой означает блокировку loop."""
+        self._ensure_started()
+        self._loop_thread = threading.get_ident()
+
+        async def heartbeat():
+            while True:
+                self._loop_beat = time.monotonic()
+                self._loop_reported = False
+                await asyncio.sleep(self.interval)
+
+        return asyncio.get_running_loop().create_task(heartbeat())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self._last_tick = time.monotonic()
+            try:
+                self._check(self._last_tick)
+            except Exception as e:
+                cool_error_handler(e, context="watchdog")
+
+    def _check(self, now):
+        stalled = []
+        with self._lock:
+            for entry in self._inflight.values():
+                if not entry[4] and self._active(entry, now) > entry[3]:
+                    entry[4] = True
+                    stalled.append((entry[0], entry[1], now - entry[2]))
+        beat = self._loop_beat
+        if beat is not None and now - beat > WATCHDOG_DEADLINE and not self._loop_reported:
+            self._loop_reported = True
+            stalled.append((self._loop_thread, "event loop", now - beat))
+        if not stalled:
+            return
+        frames = sys._current_frames()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        ts = time.strftime('%Y-%m-%d %H:%M:%S')
+        for thread_id, label, elapsed in stalled:
+            self.stalls += 1
+            frame = frames.get(thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else "(потік уже завершився)\n"
+            error_log.write(
+                "\n" + "=" * 40 + "\n"
+                f"[STALL] {label}\n"
+                f"Thread: {names.get(thread_id, thread_id)}\n"
+                f"Time: {ts}\n"
+                f"Running: {elapsed:.1f} s\n"
+                "Stack:\n"
+                f"{stack}"
+                + "=" * 40 + "\n"
+            )
+            MainProtokol(f"Зависання: {label} виконується {elapsed:.1f} с", ts='WARN')
+
+    def oldest(self):
+        """Наибольшее время работы среди выполняющихся заданий без ожиданий лимитов (0 — ничего не выполняется)."""
+        now = time.monotonic()
+        with self._lock:
+            return max((self._active(entry, now) for entry in self._inflight.values()), default=0.0)
+
+    def inflight(self):
+        return len(self._inflight)
+
+    def healthy(self):
+        now = time.monotonic()
+        if self._pid == os.getpid() and now - self._last_tick > max(self.interval * 5, 5):
+            return False
+        if self._loop_beat is not None and now - self._loop_beat > WATCHDOG_DEADLINE + self.unhealthy_after:
+            return False
+        with self._lock:
+            return all(self._active(entry, now) <= entry[3] + self.unhealthy_after
+                       for entry in self._inflight.values())
+
+watchdog = StallWatchdog()
 
 # ====== Конфигурация (читаем из Render переменных окружения) ======
 TOKEN = os.getenv("API_TOKEN", "").strip()
@@ -60,7 +775,12 @@ except Exception:
     print(f"[WARN] ADMIN_ID не является числом: {ADMIN_ID_STR}")
 
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "").strip()
+# Базовый URL Bot API (для бенчмарков можно указать локальную заглушку)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").strip()
 PORT = int(os.getenv("PORT", "5000"))
+# webhook — Flask принимает /webhook; async — то же на asyncio/aiohttp;
+# polling — бот сам забирает обновления через getUpdates
+BOT_MODE = os.getenv("BOT_MODE", "webhook").strip().lower()
 
 if not TOKEN:
     print("[ERROR] API_TOKEN не установлен!")
@@ -74,6 +794,9 @@ print(f"  - TOKEN: {'***' + TOKEN[-5:] if len(TOKEN) > 5 else '***'}")
 print(f"  - ADMIN_ID: {ADMIN_ID}")
 print(f"  - WEBHOOK_HOST: {WEBHOOK_HOST}")
 print(f"  - PORT: {PORT}")
+print(f"  - BOT_MODE: {BOT_MODE}")
+if TELEGRAM_API_BASE != "https://api.telegram.org":
+    print(f"  - TELEGRAM_API_BASE: {TELEGRAM_API_BASE}")
 
 if TOKEN and WEBHOOK_HOST:
     webhook_domain = WEBHOOK_HOST.replace("https://", "").replace("http://", "").rstrip("/")
@@ -83,51 +806,329 @@ else:
 
 print(f"[INFO] WEBHOOK_URL: {WEBHOOK_URL}")
 
+# ====== Telegram API клиент ======
+# Таймауты по методам (сек); для остальных — TELEGRAM_DEFAULT_TIMEOUT
+TELEGRAM_TIMEOUTS = {
+    'sendChatAction': 3,
+    'sendMessage': 8,
+    'deleteWebhook': 5,
+    'setWebhook': 5,
+    'getWebhookInfo': 5,
+}
+TELEGRAM_DEFAULT_TIMEOUT = 10
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "16"))
+
+# ====== Ограничение частоты запросов ======
+# Лимиты Telegram: ~30 сообщений/с всего, ~1/с в личный чат, 20/мин в группу
+RATE_GLOBAL_PER_SEC = float(os.getenv("RATE_GLOBAL_PER_SEC", "30"))
+RATE_CHAT_PER_SEC = float(os.getenv("RATE_CHAT_PER_SEC", "1"))
+RATE_CHAT_BURST = float(os.getenv("RATE_CHAT_BURST", "3"))
+RATE_GROUP_PER_MIN = float(os.getenv("RATE_GROUP_PER_MIN", "20"))
+RATE_MAX_RETRIES = int(os.getenv("RATE_MAX_RETRIES", "3"))
+RATE_MAX_RETRY_AFTER = float(os.getenv("RATE_MAX_RETRY_AFTER", "60"))
+# Методы, на которые лимиты сообщений не распространяются
+RATE_EXEMPT_METHODS = {
+    'sendChatAction', 'answerCallbackQuery', 'getUpdates',
+    'getWebhookInfo', 'setWebhook', 'deleteWebhook',
+}
+
+class TokenBucket:
+    """Token bucket с резервированием: reserve() сразу списывает токен
+    и возвращает, сколько секунд нужно подождать до его появления."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, n=1):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= n
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_take(self, n=1):
+        """Списывает токен, только если он есть сейчас (без ожидания)."""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens < n:
+                return False
+            self.tokens -= n
+            return True
+
+    def pause(self, seconds):
+        """Следующий токен станет доступен не раньше чем через ``seconds`` секунд (после 429)."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_idle(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.capacity
+
+class RateLimiter:
+    """Глобальный bucket плюс отдельный bucket на каждый chat_id."""
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(RATE_GLOBAL_PER_SEC, RATE_GLOBAL_PER_SEC)
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        key = str(chat_id)
+        with self._lock:
+            bucket = self._chats.get(key)
+            if bucket is None:
+                if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                    # Выкидываем простаивающие bucket-ы, чтобы словарь не рос бесконечно
+                    self._chats = {k: b for k, b in self._chats.items() if not b.is_idle()}
+                if key.startswith('-'):
+                    bucket = TokenBucket(RATE_GROUP_PER_MIN / 60.0, RATE_GROUP_PER_MIN)
+                else:
+                    bucket = TokenBucket(RATE_CHAT_PER_SEC, RATE_CHAT_BURST)
+                self._chats[key] = bucket
+            return bucket
+
+    def reserve(self, chat_id):
+        delay = self.global_bucket.reserve()
+        if chat_id is not None:
+            delay = max(delay, self._chat_bucket(chat_id).reserve())
+        return delay
+
+    def pause(self, chat_id, seconds):
+        if chat_id is not None:
+            self._chat_bucket(chat_id).pause(seconds)
+        else:
+            self.global_bucket.pause(seconds)
+
+def _retry_after(resp):
+    try:
+        return float(resp.json().get('parameters', {}).get('retry_after', 1))
+    except Exception:
+        return 1.0
+
+class TelegramClient:
+    """Общий клиент Bot API: одна requests.Session с пулом keep-alive соединений.
+
+    Пул urllib3 потокобезопасен, поэтому один экземпляр используется всеми потоками.
+    Перед отправкой запрос проходит через RateLimiter; на 429 клиент ждёт
+    ``parameters.retry_after`` (с jitter) и повторяет запрос до RATE_MAX_RETRIES раз.
+    Сколько запрос простоял в ограничителе, записывается в ``response.rate_wait``.
+    """
+
+    def __init__(self, token, base_url="https://api.telegram.org", pool_size=TELEGRAM_POOL_SIZE, timeouts=None):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.timeouts = dict(TELEGRAM_TIMEOUTS, **(timeouts or {}))
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self._lock = threading.Lock()
+        self.limiter = RateLimiter()
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self.rate_wait_total = 0.0
+
+    def call(self, method, params=None, files=None, timeout=None, **kwargs):
+        """Вызывает метод Bot API (POST) и возвращает requests.Response.
+
+        Параметры метода передаются именованными аргументами или словарём ``params``
+        (нужно для getUpdates, у которого есть собственный параметр ``timeout``).
+        Сетевые ошибки пробрасываются вызывающему коду.
+        """
+        params = dict(params or {}, **kwargs)
+        url = f"{self.base_url}/bot{self.token}/{method}"
+        if timeout is None:
+            timeout = self.timeouts.get(method, TELEGRAM_DEFAULT_TIMEOUT)
+        limited = method not in RATE_EXEMPT_METHODS
+        chat_id = params.get('chat_id')
+        waited = 0.0
+        attempt = 0
+        while True:
+            if limited:
+                delay = self.limiter.reserve(chat_id)
+                if delay > 0:
+                    with watchdog.waiting():
+                        time.sleep(delay)
+                    waited += delay
+            with self._lock:
+                self.calls += 1
+            started = time.perf_counter()
+            try:
+                with trace_span(f"api:{method}"):
+                    resp = self.session.post(url, data=params, files=files, timeout=timeout)
+            except Exception:
+                API_LATENCY.observe(time.perf_counter() - started, method, "error")
+                with self._lock:
+                    self.errors += 1
+                    self.rate_wait_total += waited
+                raise
+            API_LATENCY.observe(time.perf_counter() - started, method, resp.status_code)
+            if resp.status_code != 429 or attempt >= RATE_MAX_RETRIES:
+                break
+            retry_after = _retry_after(resp)
+            if retry_after > RATE_MAX_RETRY_AFTER:
+                break
+            attempt += 1
+            with self._lock:
+                self.throttled += 1
+            backoff = retry_after + random.uniform(0, 0.1 * retry_after + 0.05)
+            if limited:
+                # Пауза действует и на параллельные запросы в тот же чат
+                self.limiter.pause(chat_id, backoff)
+            else:
+                with watchdog.waiting():
+                    time.sleep(backoff)
+                waited += backoff
+        resp.rate_wait = waited
+        with self._lock:
+            self.rate_wait_total += waited
+        return resp
+
+    def connection_stats(self):
+        """Сколько соединений открыто заново и сколько запросов ушло по уже открытым."""
+        opened = 0
+        sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            sent += pool.num_requests
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "rate_wait_total": round(self.rate_wait_total, 3),
+            "connections_opened": opened,
+            "connections_reused": max(sent - opened, 0),
+        }
+
+tg = TelegramClient(TOKEN, base_url=TELEGRAM_API_BASE)
+
 # ====== Установка webhook ======
+WEBHOOK_MAX_CONNECTIONS = os.getenv("WEBHOOK_MAX_CONNECTIONS", "").strip()
+# Каталог маркеров «webhook уже сверен»
+WEBHOOK_STATE_DIR = os.getenv("WEBHOOK_STATE_DIR", tempfile.gettempdir()).strip()
+# Идентификатор деплоя: воркеры одного деплоя делят маркер. Без DEPLOY_ID/RENDER_GIT_COMMIT —
+# pid родителя (мастер gunicorn), поэтому новый запуск сервиса сверяет webhook заново
+WEBHOOK_DEPLOY_ID = (os.getenv("DEPLOY_ID") or os.getenv("RENDER_GIT_COMMIT") or f"ppid-{os.getppid()}").strip()
+# Маркер старше этого срока не учитывается (webhook могли поменять на стороне Telegram)
+WEBHOOK_MARKER_TTL = float(os.getenv("WEBHOOK_MARKER_TTL", "600"))
+
+def _webhook_marker_prefix():
+    return "bot-webhook-" + hashlib.sha256(TOKEN.encode()).hexdigest()[:12] + "-"
+
+def _webhook_marker_path():
+    fingerprint = hashlib.sha256(
+        f"{WEBHOOK_URL}|{WEBHOOK_MAX_CONNECTIONS}|{WEBHOOK_DEPLOY_ID}".encode()).hexdigest()[:16]
+    return os.path.join(WEBHOOK_STATE_DIR, f"{_webhook_marker_prefix()}{fingerprint}.done")
+
+def clear_webhook_markers():
+    """Удаляет маркеры этого бота — после deleteWebhook следующий старт обязан сверить webhook."""
+    prefix = _webhook_marker_prefix()
+    try:
+        names = [n for n in os.listdir(WEBHOOK_STATE_DIR) if n.startswith(prefix)]
+    except OSError:
+        return
+    for name in names:
+        try:
+            os.remove(os.path.join(WEBHOOK_STATE_DIR, name))
+        except OSError:
+            pass
+
+def _claim_webhook_marker(marker):
+    """True, если этот процесс должен сверить webhook (маркер создан им)."""
+    for _ in range(2):
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(marker) < WEBHOOK_MARKER_TTL:
+                    return False
+                os.remove(marker)  # устаревший маркер — пробуем занять заново
+            except OSError:
+                pass
+    return False
+
 def set_webhook():
+    """Сверяет webhook с getWebhookInfo и вызывает setWebhook только при расхождении.
+
+    deleteWebhook не вызывается, поэтому обновления не теряются при перезапуске.
+    Возвращает True, если webhook в нужном состоянии.
+    """
     if not TOKEN:
         print("[WARN] TOKEN is not set, webhook not initialized.")
-        return
+        return False
     if not WEBHOOK_URL:
         print("[INFO] WEBHOOK_HOST not set; skip setting webhook.")
-        return
+        return False
     try:
-        r_delete = requests.get(
-            f"https://api.telegram.org/bot{TOKEN}/deleteWebhook",
-            timeout=5
-        )
-        print(f"[INFO] Delete webhook response: {r_delete.status_code}")
-        
-        r = requests.post(
-            f"https://api.telegram.org/bot{TOKEN}/setWebhook",
-            data={"url": WEBHOOK_URL},
-            timeout=5
-        )
+        info = tg.call("getWebhookInfo").json().get('result') or {}
+        same_url = info.get('url') == WEBHOOK_URL
+        same_conn = not WEBHOOK_MAX_CONNECTIONS or str(info.get('max_connections')) == WEBHOOK_MAX_CONNECTIONS
+        if same_url and same_conn:
+            print(f"[INFO] Webhook вже встановлено: {WEBHOOK_URL}")
+            return True
+
+        params = {"url": WEBHOOK_URL}
+        if WEBHOOK_MAX_CONNECTIONS:
+            params["max_connections"] = WEBHOOK_MAX_CONNECTIONS
+        r = tg.call("setWebhook", params)
         
         if r.ok:
             result = r.json()
             print(f"[SUCCESS] Webhook успешно установлен!")
             print(f"[INFO] Response: {result}")
             MainProtokol(f"Webhook установлен: {WEBHOOK_URL}")
-        else:
-            print(f"[ERROR] Ошибка при установке webhook: {r.status_code}")
-            print(f"[ERROR] Response: {r.text}")
-            MainProtokol(f"setWebhook failed: {r.status_code} {r.text}", ts='WARN')
+            return True
+        print(f"[ERROR] Ошибка при установке webhook: {r.status_code}")
+        print(f"[ERROR] Response: {r.text}")
+        MainProtokol(f"setWebhook failed: {r.status_code} {r.text}", ts='WARN')
     except Exception as e:
         cool_error_handler(e, context="set_webhook")
+    return False
+
+def ensure_webhook_once():
+    """Сверка webhook один раз на деплой: первый воркер создаёт маркер, остальные пропускают."""
+    marker = _webhook_marker_path()
+    try:
+        if not _claim_webhook_marker(marker):
+            return
+    except OSError as e:
+        cool_error_handler(e, context="ensure_webhook_once: marker")
+        set_webhook()
+        return
+    if not set_webhook():
+        # Не получилось — следующий старт попробует снова
+        try:
+            os.remove(marker)
+        except OSError:
+            pass
 
-set_webhook()
+if BOT_MODE in ("webhook", "async"):
+    # Вне критического пути: приложение начинает принимать запросы сразу
+    threading.Thread(target=ensure_webhook_once, name="webhook-setup", daemon=True).start()
 
 # ====== UI helpers ======
 def send_chat_action(chat_id, action='typing'):
     if not TOKEN:
         return
     try:
-        requests.post(
-            f'https://api.telegram.org/bot{TOKEN}/sendChatAction',
-            data={'chat_id': chat_id, 'action': action},
-            timeout=3
-        )
+        tg.call('sendChatAction', chat_id=chat_id, action=action)
     except Exception:
         pass
 
@@ -169,7 +1170,6 @@ def send_message(chat_id, text, reply_markup=None, parse_mode=None, timeout=8):
     if not TOKEN:
         print("[WARN] Попытка отправки сообщения без TOKEN")
         return None
-    url = f'https://api.telegram.org/bot{TOKEN}/sendMessage'
     payload = {
         'chat_id': chat_id,
         'text': text
@@ -179,7 +1179,7 @@ def send_message(chat_id, text, reply_markup=None, parse_mode=None, timeout=8):
     if parse_mode:
         payload['parse_mode'] = parse_mode
     try:
-        resp = requests.post(url, data=payload, timeout=timeout)
+        resp = tg.call('sendMessage', timeout=timeout, **payload)
         if not resp.ok:
             MainProtokol(resp.text, 'Помилка надсилання')
         return resp
@@ -188,6 +1188,15 @@ def send_message(chat_id, text, reply_markup=None, parse_mode=None, timeout=8):
         MainProtokol(str(e), 'Помилка мережі')
         return None
 
+REPORT_KEYBOARD = {
+    "keyboard": [
+        [{"text": "✅ Готово"}],
+        [{"text": "❌ Скасувати"}]
+    ],
+    "resize_keyboard": True,
+    "one_time_keyboard": False
+}
+
 def _get_reply_markup_for_admin(user_id: int):
     kb = {
         "inline_keyboard": [
@@ -257,281 +1266,2261 @@ def build_admin_info(message: dict) -> str:
         cool_error_handler(e, "build_admin_info")
         return "Нова подія від користувача."
 
-def _post_request(url, data=None, timeout=10):
+def _post_request(method, data=None, timeout=None):
     try:
-        r = requests.post(url, data=data, timeout=timeout)
+        r = tg.call(method, data, timeout=timeout)
         if not r.ok:
-            MainProtokol(f"Request failed: {url} -> {r.status_code} {r.text}", ts='WARN')
+            MainProtokol(f"Request failed: {method} -> {r.status_code} {r.text}", ts='WARN')
         return r
     except Exception as e:
-        MainProtokol(f"Network error for {url}: {str(e)}", ts='ERROR')
+        MainProtokol(f"Network error for {method}: {str(e)}", ts='ERROR')
         return None
 
+def build_admin_reply_request(user_id: int, admin_msg: dict):
+    """Метод Bot API и параметры для пересылки ответа админа пользователю"""
+    caption = admin_msg.get('caption') or admin_msg.get('text') or ""
+    safe_caption = escape(caption) if caption else None
+
+    if 'photo' in admin_msg:
+        file_id = admin_msg['photo'][-1].get('file_id')
+        payload = {"chat_id": user_id, "photo": file_id}
+        if safe_caption:
+            payload["caption"] = f"💬 Відповідь адміністратора:\n<pre>{safe_caption}</pre>"
+            payload["parse_mode"] = "HTML"
+        else:
+            payload["caption"] = "💬 Відповідь адміністратора"
+        return "sendPhoto", payload
+
+    if 'video' in admin_msg:
+        file_id = admin_msg['video'].get('file_id')
+        payload = {"chat_id": user_id, "video": file_id}
+        if safe_caption:
+            payload["caption"] = f"💬 Відповідь адміністратора:\n<pre>{safe_caption}</pre>"
+            payload["parse_mode"] = "HTML"
+        else:
+            payload["caption"] = "💬 Відповідь адміністратора"
+        return "sendVideo", payload
+
+    if 'document' in admin_msg:
+        file_id = admin_msg['document'].get('file_id')
+        filename = admin_msg.get('document', {}).get('file_name', 'документ')
+        payload = {"chat_id": user_id, "document": file_id}
+        if safe_caption:
+            payload["caption"] = f"💬 Відповідь адміністратора:\n<pre>{safe_caption}</pre>"
+            payload["parse_mode"] = "HTML"
+        else:
+            payload["caption"] = f"💬 Відповідь адміністратора — {escape(filename)}"
+        return "sendDocument", payload
+
+    if caption:
+        return "sendMessage", {"chat_id": user_id, "text": f"💬 Відповідь адміністратора:\n<pre>{escape(caption)}</pre>", "parse_mode": "HTML"}
+
+    return "sendMessage", {"chat_id": user_id, "text": "💬 Відповідь адміністратора (без тексту)."}
+
 def forward_admin_message_to_user(user_id: int, admin_msg: dict):
     try:
         if not user_id:
             return False
-        
-        caption = admin_msg.get('caption') or admin_msg.get('text') or ""
-        safe_caption = escape(caption) if caption else None
-
-        if 'photo' in admin_msg:
-            file_id = admin_msg['photo'][-1].get('file_id')
-            url = f"https://api.telegram.org/bot{TOKEN}/sendPhoto"
-            payload = {"chat_id": user_id, "photo": file_id}
-            if safe_caption:
-                payload["caption"] = f"💬 Відповідь адміністратора:\n<pre>{safe_caption}</pre>"
-                payload["parse_mode"] = "HTML"
-            else:
-                payload["caption"] = "💬 Відповідь адміністратора"
-            _post_request(url, data=payload)
-            return True
-
-        if 'video' in admin_msg:
-            file_id = admin_msg['video'].get('file_id')
-            url = f"https://api.telegram.org/bot{TOKEN}/sendVideo"
-            payload = {"chat_id": user_id, "video": file_id}
-            if safe_caption:
-                payload["caption"] = f"💬 Відповідь адміністратора:\n<pre>{safe_caption}</pre>"
-                payload["parse_mode"] = "HTML"
-            else:
-                payload["caption"] = "💬 Відповідь адміністратора"
-            _post_request(url, data=payload)
-            return True
-
-        if 'document' in admin_msg:
-            file_id = admin_msg['document'].get('file_id')
-            filename = admin_msg.get('document', {}).get('file_name', 'документ')
-            url = f"https://api.telegram.org/bot{TOKEN}/sendDocument"
-            payload = {"chat_id": user_id, "document": file_id}
-            if safe_caption:
-                payload["caption"] = f"💬 Відповідь адміністратора:\n<pre>{safe_caption}</pre>"
-                payload["parse_mode"] = "HTML"
-            else:
-                payload["caption"] = f"💬 Відповідь адміністратора — {escape(filename)}"
-            _post_request(url, data=payload)
-            return True
 
-        if caption:
-            send_message(user_id, f"💬 Відповідь адміністратора:\n<pre>{escape(caption)}</pre>", parse_mode="HTML")
-            return True
-
-        send_message(user_id, "💬 Відповідь адміністратора (без тексту).")
+        method, payload = build_admin_reply_request(user_id, admin_msg)
+        if method == "sendMessage":
+            send_message(user_id, payload["text"], parse_mode=payload.get("parse_mode"))
+        else:
+            _post_request(method, data=payload)
         return True
     except Exception as e:
         cool_error_handler(e, "forward_admin_message_to_user")
         return False
 
-# ====== Глобальное состояние ======
-waiting_for_admin = {}
-user_messages = {}  # chat_id -> list of messages
+# ====== Очередь исходящих сообщений ======
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))
+OUTBOX_MAX_DEPTH = int(os.getenv("OUTBOX_MAX_DEPTH", "2000"))
+OUTBOX_PUT_TIMEOUT = float(os.getenv("OUTBOX_PUT_TIMEOUT", "0.5"))
 
-# ====== Flask App ======
-app = Flask(__name__)
+class Outbox:
+    """Фоновая отправка исходящих вызовов.
 
-@app.errorhandler(Exception)
-def flask_global_error_handler(e):
-    cool_error_handler(e, context="Flask global error handler")
-    return "Внутрішня помилка сервера.", 500
+    Задания одного chat_id выполняются строго по порядку постановки,
+    задания разных чатов — параллельно в пуле из ``workers`` потоков.
+    Если очередь заполнена, ``submit`` ждёт до ``put_timeout`` секунд,
+    после чего задание отбрасывается и учитывается в ``dropped``.
+    Задания чата ``priority`` (админа) принимаются всегда и выполняются
+    первыми среди готовых чатов.
+    """
 
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    global waiting_for_admin, user_messages
-    try:
-        data_raw = request.get_data(as_text=True)
-        update = json.loads(data_raw)
-
-        # CALLBACK HANDLING
-        if 'callback_query' in update:
-            call = update['callback_query']
-            chat_id = call['from']['id']
-            data = call.get('data', '')
-
-            if data.startswith("reply_") and chat_id == ADMIN_ID:
-                try:
-                    user_id = int(data.split("_", 1)[1])
-                    waiting_for_admin[ADMIN_ID] = user_id
-                    send_message(
-                        ADMIN_ID,
-                        f"✍️ Введіть відповідь для користувача {user_id} (текст або файл):"
-                    )
-                except Exception as e:
-                    cool_error_handler(e, context="webhook: callback_query reply_")
-                    MainProtokol(str(e), 'Помилка callback reply')
-
-            return "ok", 200
-
-        # MESSAGE HANDLING
-        if 'message' in update:
-            message = update['message']
-            chat = message.get('chat') or {}
-            frm = message.get('from') or {}
-            chat_id = chat.get('id')
-            from_id = frm.get('id')
-            text = message.get('text', '')
-
-            # Ответ администратора пользователю
-            if from_id == ADMIN_ID and ADMIN_ID in waiting_for_admin:
-                user_to_send = waiting_for_admin.pop(ADMIN_ID, None)
-                success = False
-                if user_to_send:
-                    success = forward_admin_message_to_user(user_to_send, message)
-                if success:
-                    send_message(ADMIN_ID, f"✅ Повідомлення надіслано користувачу {user_to_send}.", reply_markup=get_reply_buttons())
+    def __init__(self, workers=OUTBOX_WORKERS, max_depth=OUTBOX_MAX_DEPTH, put_timeout=OUTBOX_PUT_TIMEOUT,
+                 priority=None):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.put_timeout = put_timeout
+        self.priority = priority
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._reset()
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._lanes = {}       # chat_id -> deque заданий (пока чат в очереди или выполняется)
+        self._ready = deque()  # chat_id, готовые к выполнению
+        self._depth = 0
+        self._running = 0
+        self._threads = []
+
+    def _ensure_started(self):
+        # Потоки стартуют лениво и заново после fork (gunicorn --preload): потоков
+        # родителя в дочернем процессе нет, а его блокировка могла остаться захваченной.
+        # Задания, поставленные до fork, остаются за родителем.
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                self._reset()
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._pid = os.getpid()
+
+    def submit(self, chat_id, fn, *args, **kwargs):
+        self._ensure_started()
+        with self._lock:
+            if self._depth >= self.max_depth and chat_id != self.priority:
+                self._not_full.wait_for(lambda: self._depth < self.max_depth, timeout=self.put_timeout)
+                if self._depth >= self.max_depth:
+                    self.dropped += 1
+                    drop = True
                 else:
-                    send_message(ADMIN_ID, f"❌ Не вдалося надіслати повідомлення користувачу {user_to_send}.", reply_markup=get_reply_buttons())
-                return "ok", 200
-
-            # /start команда
-            if text == '/start':
-                send_chat_action(chat_id, 'typing')
-                time.sleep(0.25)
-                user = message.get('from', {})
-                welcome = build_welcome_message(user)
-                send_message(
-                    chat_id,
-                    welcome,
-                    reply_markup=get_reply_buttons(),
-                    parse_mode='HTML'
-                )
-            # Кнопка "📝 Повідомити про подію"
-            elif text == "📝 Повідомити про подію":
-                # Инициализируем сбор сообщений
-                user_messages[chat_id] = []
-                send_message(
-                    chat_id,
-                    "📝 Надсилайте вашу інформацію (текст, фото, відео, документи).\n\n"
-                    "Натисніть 'Готово' коли закінчите.",
-                    reply_markup={
-                        "keyboard": [
-                            [{"text": "✅ Готово"}],
-                            [{"text": "❌ Скасувати"}]
-                        ],
-                        "resize_keyboard": True,
-                        "one_time_keyboard": False
-                    }
-                )
-            # Готово - отправляем все собранные сообщения админу
-            elif text == "✅ Готово":
-                send_message(chat_id, "✅ Дякуємо! Ваша інформація відправлена адміністратору.", reply_markup=get_reply_buttons())
-                
-                # Отправляем информацию о пользователе
-                if chat_id in user_messages and user_messages[chat_id]:
-                    first_msg = user_messages[chat_id][0]
-                    admin_info = build_admin_info(first_msg)
-                    orig_user_id = first_msg.get('from', {}).get('id')
-                    reply_markup = _get_reply_markup_for_admin(orig_user_id)
-                    send_message(ADMIN_ID, admin_info, reply_markup=reply_markup, parse_mode="HTML")
-                    
-                    # Отправляем все собранные медиа
-                    for msg in user_messages[chat_id]:
-                        send_collected_message(ADMIN_ID, msg)
-                    
-                    # Очищаем список
-                    user_messages.pop(chat_id, None)
-            # Скасувати
-            elif text == "❌ Скасувати":
-                send_message(chat_id, "❌ Скасовано.", reply_markup=get_reply_buttons())
-                user_messages.pop(chat_id, None)
-            # Собираем все остальные сообщения
+                    drop = False
             else:
-                if from_id != ADMIN_ID and chat_id in user_messages:
-                    user_messages[chat_id].append(message)
-                    send_message(
-                        chat_id,
-                        "✅ Додано. Продовжуйте надсилати або натисніть ✅ Готово.",
-                        reply_markup={
-                            "keyboard": [
-                                [{"text": "✅ Готово"}],
-                                [{"text": "❌ Скасувати"}]
-                            ],
-                            "resize_keyboard": True,
-                            "one_time_keyboard": False
-                        }
-                    )
+                drop = False
+            if not drop:
+                lane = self._lanes.get(chat_id)
+                if lane is None:
+                    lane = self._lanes[chat_id] = deque()
+                    self._make_ready(chat_id)
+                trace = current_trace()
+                if trace is not None:
+                    trace.hold()
+                lane.append((fn, args, kwargs, trace))
+                self._depth += 1
+                self.submitted += 1
+        if drop:
+            MainProtokol(f"Outbox переповнено, завдання для {chat_id} відкинуто", ts='WARN')
+            return False
+        return True
 
-        return "ok", 200
+    def _worker(self):
+        while True:
+            with self._lock:
+                self._not_empty.wait_for(lambda: self._ready)
+                chat_id = self._ready.popleft()
+                fn, args, kwargs, trace = self._lanes[chat_id].popleft()
+                self._running += 1
+            token = watchdog.begin(f"outbox {getattr(fn, '__name__', fn)} -> {chat_id}", WATCHDOG_OUTBOX_DEADLINE)
+            try:
+                if trace is None:
+                    fn(*args, **kwargs)
+                else:
+                    with use_trace(trace):
+                        fn(*args, **kwargs)
+            except Exception as e:
+                cool_error_handler(e, context=f"outbox: {getattr(fn, '__name__', fn)}")
+            watchdog.end(token)
+            with self._lock:
+                self._running -= 1
+                self._depth -= 1
+                self.completed += 1
+                if self._lanes[chat_id]:
+                    self._make_ready(chat_id)
+                else:
+                    del self._lanes[chat_id]
+                self._not_full.notify_all()
 
-    except Exception as e:
-        cool_error_handler(e, context="webhook - outer")
-        MainProtokol(str(e), 'Помилка webhook')
-        return "ok", 200
+    def _make_ready(self, chat_id):
+        # Вызывается под self._lock
+        if chat_id == self.priority:
+            self._ready.appendleft(chat_id)
+        else:
+            self._ready.append(chat_id)
+        self._not_empty.notify()
 
-def send_collected_message(chat_id, message: dict):
-    """Отправляет собранное сообщение (фото, видео, текст и т.д.) админу"""
-    try:
-        if 'photo' in message:
-            file_id = message['photo'][-1].get('file_id')
-            caption = message.get('caption', '')
-            url = f"https://api.telegram.org/bot{TOKEN}/sendPhoto"
-            payload = {"chat_id": chat_id, "photo": file_id}
-            if caption:
-                payload["caption"] = escape(caption)
-            requests.post(url, data=payload, timeout=10)
-            return
+    def depth(self):
+        return self._depth if self._pid == os.getpid() else 0
 
-        if 'video' in message:
-            file_id = message['video'].get('file_id')
-            caption = message.get('caption', '')
-            url = f"https://api.telegram.org/bot{TOKEN}/sendVideo"
-            payload = {"chat_id": chat_id, "video": file_id}
-            if caption:
-                payload["caption"] = escape(caption)
-            requests.post(url, data=payload, timeout=10)
-            return
+    def wait_idle(self, timeout=None):
+        """Ждёт, пока все поставленные задания будут выполнены."""
+        if self._pid != os.getpid():
+            return True
+        with self._lock:
+            return self._not_full.wait_for(lambda: self._depth == 0, timeout=timeout)
 
-        if 'document' in message:
-            file_id = message['document'].get('file_id')
-            caption = message.get('caption', '')
-            url = f"https://api.telegram.org/bot{TOKEN}/sendDocument"
-            payload = {"chat_id": chat_id, "document": file_id}
-            if caption:
-                payload["caption"] = escape(caption)
-            requests.post(url, data=payload, timeout=10)
-            return
+outbox = Outbox(priority=ADMIN_ID)
 
-        if 'audio' in message:
-            file_id = message['audio'].get('file_id')
-            caption = message.get('caption', '')
-            url = f"https://api.telegram.org/bot{TOKEN}/sendAudio"
-            payload = {"chat_id": chat_id, "audio": file_id}
-            if caption:
-                payload["caption"] = escape(caption)
-            requests.post(url, data=payload, timeout=10)
-            return
+# ====== Подтверждения «✅ Додано» ======
+ACK_QUIET_WINDOW = float(os.getenv("ACK_QUIET_WINDOW", "1.0"))
 
-        if 'voice' in message:
-            file_id = message['voice'].get('file_id')
-            url = f"https://api.telegram.org/bot{TOKEN}/sendVoice"
-            payload = {"chat_id": chat_id, "voice": file_id}
-            requests.post(url, data=payload, timeout=10)
-            return
+class AckDebouncer:
+    """Объединяет подтверждения добавленных сообщений.
 
-        if 'text' in message:
-            text = message['text']
-            send_message(chat_id, f"<pre>{escape(text)}</pre>", parse_mode="HTML")
-            return
+    Альбом из 10 фото приходит десятью update с общим media_group_id; вместо
+    десяти ответов пользователь получает одно подтверждение со счётчиком —
+    после ``window`` секунд тишины в этом чате.
+    """
 
-    except Exception as e:
-        MainProtokol(f"Error sending collected message: {str(e)}", ts='ERROR')
+    def __init__(self, window=ACK_QUIET_WINDOW):
+        self.window = window
+        self._cond = threading.Condition()
+        self._pending = {}  # chat_id -> [срок, сколько добавлено]
+        self._pid = None
+        self.coalesced = 0
 
-@app.route('/', methods=['GET'])
-def index():
-    try:
-        MainProtokol('Відвідання сайту')
-        return "Бот працює ✅", 200
-    except Exception as e:
-        cool_error_handler(e, context="index route")
-        return "Error", 500
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="ack-debouncer", daemon=True).start()
 
-if __name__ == "__main__":
+    def add(self, chat_id):
+        if self.window <= 0:
+            send_added_ack(chat_id, 1)
+            return
+        with self._cond:
+            self._ensure_started()
+            entry = self._pending.get(chat_id)
+            if entry is None:
+                self._pending[chat_id] = [time.monotonic() + self.window, 1]
+                self._cond.notify()
+            else:
+                entry[0] = time.monotonic() + self.window
+                entry[1] += 1
+                self.coalesced += 1
+
+    def cancel(self, chat_id):
+        with self._cond:
+            self._pending.pop(chat_id, None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = [(cid, entry[1]) for cid, entry in self._pending.items() if entry[0] <= now]
+                for cid, _ in due:
+                    del self._pending[cid]
+                if not due:
+                    self._cond.wait(min(entry[0] for entry in self._pending.values()) - now)
+                    continue
+            for chat_id, count in due:
+                send_added_ack(chat_id, count)
+
+def send_added_ack(chat_id, count):
+    outbox.submit(chat_id, deliver_added_ack, chat_id, count)
+
+def deliver_added_ack(chat_id, count):
+    """Подтверждение уходит, только если отчёт ещё открыт: «✅ Готово» могло попасть
+    на другой воркер, и тогда клавиатура отчёта после «Дякуємо» только запутает."""
+    if not sessions.has_report(chat_id):
+        return
+    counter = f" ({count})" if count > 1 else ""
+    send_message(
+        chat_id,
+        f"✅ Додано{counter}. Продовжуйте надсилати або натисніть ✅ Готово.",
+        reply_markup=REPORT_KEYBOARD
+    )
+
+acks = AckDebouncer()
+
+# ====== Хранилище сессий ======
+SESSION_STORE = os.getenv("SESSION_STORE", "memory").strip().lower()
+SESSION_DB = os.getenv("SESSION_DB", "sessions.db").strip()
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(24 * 3600)))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+REPORT_MAX_ITEMS = int(os.getenv("REPORT_MAX_ITEMS", "100"))
+REPORT_MAX_TEXT_BYTES = int(os.getenv("REPORT_MAX_TEXT_BYTES", str(64 * 1024)))
+SESSION_MEMORY_BUDGET = int(os.getenv("SESSION_MEMORY_BUDGET", str(32 * 1024 * 1024)))
+
+# Типы сообщений, у которых есть file_id (порядок важен: у видео-документа есть и document)
+_MEDIA_KINDS = ('photo', 'video', 'animation', 'document', 'audio', 'voice', 'video_note', 'sticker')
+
+class ReportItem:
+    """Компактная запись собранного сообщения вместо полного update от Telegram."""
+
+    __slots__ = ('kind', 'file_id', 'caption', 'message_id', 'media_group_id')
+
+    def __init__(self, kind, file_id, caption, message_id, media_group_id=None):
+        self.kind = kind
+        self.file_id = file_id
+        self.caption = caption
+        self.message_id = message_id
+        self.media_group_id = media_group_id
+
+    @classmethod
+    def from_message(cls, message: dict):
+        for kind in _MEDIA_KINDS:
+            media = message.get(kind)
+            if media:
+                # photo — список размеров, берём самый большой
+                file_id = (media[-1] if kind == 'photo' else media).get('file_id')
+                return cls(kind, file_id, message.get('caption') or None, message.get('message_id'),
+                           message.get('media_group_id'))
+        if 'text' in message:
+            return cls('text', None, message['text'], message.get('message_id'))
+        # Геолокации, контакты, опросы и т.д. доставляются только через copyMessage(s)
+        return cls('other', None, message.get('caption') or None, message.get('message_id'))
+
+    def to_row(self):
+        return [self.kind, self.file_id, self.caption, self.message_id, self.media_group_id]
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    def text_bytes(self):
+        """Объём текста/подписи в UTF-8 — для квоты REPORT_MAX_TEXT_BYTES."""
+        return len(self.caption.encode('utf-8')) if self.caption else 0
+
+    def nbytes(self):
+        return (sys.getsizeof(self) + sys.getsizeof(self.kind) + sys.getsizeof(self.file_id)
+                + sys.getsizeof(self.caption) + sys.getsizeof(self.message_id)
+                + sys.getsizeof(self.media_group_id))
+
+class ReportSession:
+    """Собираемый отчёт: автор (поле from), дата первого сообщения и элементы."""
+
+    __slots__ = ('user', 'date', 'items', 'touched', 'nbytes', 'text_bytes')
+
+    def __init__(self, user=None, date=None, items=None):
+        self.user = user or {}
+        self.date = date
+        self.items = items if items is not None else []
+        self.text_bytes = sum(item.text_bytes() for item in self.items)
+        self.touched = time.time()
+        self.nbytes = sys.getsizeof(self) + sys.getsizeof(self.items) + sys.getsizeof(json.dumps(self.user))
+
+    def header_message(self):
+        """Сообщение-заготовка для build_admin_info."""
+        first = self.items[0] if self.items else None
+        return {
+            'from': self.user,
+            'message_id': first.message_id if first else '-',
+            'date': self.date,
+            'caption': first.caption if first else '',
+        }
+
+def _compact_user(user: dict):
+    return {k: user[k] for k in ('id', 'first_name', 'last_name', 'username', 'is_premium') if user.get(k) is not None}
+
+class SessionStore:
+    """Состояние диалогов: кому отвечает админ (waiting) и собираемые отчёты (reports).
+
+    Отчёт ограничен REPORT_MAX_ITEMS элементами и REPORT_MAX_TEXT_BYTES байтами
+    текста. Сессии, к которым не обращались дольше SESSION_TTL, удаляет фоновый
+    поток раз в SESSION_SWEEP_INTERVAL.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_items=REPORT_MAX_ITEMS, max_text_bytes=REPORT_MAX_TEXT_BYTES):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_text_bytes = max_text_bytes
+        self.evicted = 0
+        self._sweeper_pid = None
+
+    def set_waiting(self, admin_id, user_id):
+        raise NotImplementedError
+
+    def pop_waiting(self, admin_id):
+        """Возвращает user_id, которому отвечает админ, и сбрасывает ожидание (или None)."""
+        raise NotImplementedError
+
+    def start_report(self, chat_id, user: dict):
+        """Начинает (или перезапускает) сбор отчёта для чата."""
+        raise NotImplementedError
+
+    def add_item(self, chat_id, message: dict):
+        """Добавляет сообщение в отчёт.
+
+        True — добавлено, False — превышена квота отчёта, None — отчёт не начат.
+        """
+        raise NotImplementedError
+
+    def pop_report(self, chat_id):
+        """Забирает ReportSession и закрывает сессию (None, если сессии нет)."""
+        raise NotImplementedError
+
+    def has_report(self, chat_id):
+        """Идёт ли сейчас сбор отчёта в чате."""
+        raise NotImplementedError
+
+    def is_lost(self, chat_id):
+        """Был ли открытый отчёт чата вытеснен или удалён по TTL (до нового старта или pop_lost)."""
+        raise NotImplementedError
+
+    def pop_lost(self, chat_id):
+        """Как is_lost, но сбрасывает отметку."""
+        raise NotImplementedError
+
+    def drop_report(self, chat_id):
+        raise NotImplementedError
+
+    def expire(self):
+        """Удаляет заброшенные сессии; возвращает их количество."""
+        raise NotImplementedError
+
+    def stats(self):
+        """{'sessions': активных отчётов, 'items': собрано элементов, 'bytes': оценка памяти}"""
+        raise NotImplementedError
+
+    def claim_update(self, update_id):
+        """Отмечает update_id обработанным; False, если его уже обработал другой воркер.
+
+        Хранилище в памяти процесса ничего не разделяет — дубликаты ловит UpdateDeduplicator.
+        """
+        return True
+
+    def release_update(self, update_id):
+        """Снимает отметку claim_update — обновление не было принято и придёт повторно."""
+
+    def _ensure_sweeper(self):
+        if self._sweeper_pid == os.getpid():
+            return
+        self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True).start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(SESSION_SWEEP_INTERVAL)
+            try:
+                expired = self.expire()
+                if expired:
+                    MainProtokol(f"Видалено покинутих сесій: {expired}")
+            except Exception as e:
+                cool_error_handler(e, context="session sweeper")
+
+class MemorySessionStore(SessionStore):
+    """Состояние в памяти процесса (один воркер, теряется при перезапуске).
+
+    Общий объём отчётов ограничен SESSION_MEMORY_BUDGET: при превышении
+    вытесняются сессии, к которым дольше всех не обращались (LRU).
+    """
+
+    MAX_LOST = 10000
+
+    def __init__(self, ttl=SESSION_TTL, max_items=REPORT_MAX_ITEMS, max_text_bytes=REPORT_MAX_TEXT_BYTES,
+                 memory_budget=SESSION_MEMORY_BUDGET):
+        super().__init__(ttl, max_items, max_text_bytes)
+        self.memory_budget = memory_budget
+        self._lock = threading.Lock()
+        self.waiting_for_admin = {}
+        self.user_messages = OrderedDict()  # chat_id -> ReportSession, от давно не тронутых к свежим
+        self.lost = OrderedDict()  # chat_id -> когда отчёт вытеснен/истёк; пользователь ещё не знает
+        self.total_bytes = 0
+
+    def set_waiting(self, admin_id, user_id):
+        with self._lock:
+            self.waiting_for_admin[admin_id] = user_id
+
+    def pop_waiting(self, admin_id):
+        with self._lock:
+            return self.waiting_for_admin.pop(admin_id, None)
+
+    def start_report(self, chat_id, user: dict):
+        self._ensure_sweeper()
+        session = ReportSession(_compact_user(user))
+        with self._lock:
+            self._remove(chat_id)
+            self.lost.pop(chat_id, None)
+            self.user_messages[chat_id] = session
+            self.total_bytes += session.nbytes
+            self._enforce_budget()
+
+    def add_item(self, chat_id, message: dict):
+        item = ReportItem.from_message(message)
+        size = item.nbytes()
+        text_bytes = item.text_bytes()
+        with self._lock:
+            session = self.user_messages.get(chat_id)
+            if session is None:
+                return None
+            if len(session.items) >= self.max_items or session.text_bytes + text_bytes > self.max_text_bytes:
+                return False
+            if not session.items:
+                session.date = message.get('date')
+            session.items.append(item)
+            session.text_bytes += text_bytes
+            session.nbytes += size
+            session.touched = time.time()
+            self.total_bytes += size
+            self.user_messages.move_to_end(chat_id)
+            self._enforce_budget()
+            return True
+
+    def _remove(self, chat_id):
+        session = self.user_messages.pop(chat_id, None)
+        if session is not None:
+            self.total_bytes -= session.nbytes
+        return session
+
+    def _mark_lost(self, chat_id):
+        self.lost[chat_id] = time.time()
+        self.lost.move_to_end(chat_id)
+        while len(self.lost) > self.MAX_LOST:
+            self.lost.popitem(last=False)
+
+    def _enforce_budget(self):
+        # Последняя (текущая) сессия не вытесняется
+        while self.total_bytes > self.memory_budget and len(self.user_messages) > 1:
+            chat_id = next(iter(self.user_messages))
+            self._remove(chat_id)
+            self._mark_lost(chat_id)
+            self.evicted += 1
+            MainProtokol(f"Сесію {chat_id} витіснено: перевищено бюджет пам'яті", ts='WARN')
+
+    def pop_report(self, chat_id):
+        with self._lock:
+            return self._remove(chat_id)
+
+    def has_report(self, chat_id):
+        with self._lock:
+            return chat_id in self.user_messages
+
+    def is_lost(self, chat_id):
+        with self._lock:
+            return chat_id in self.lost
+
+    def pop_lost(self, chat_id):
+        with self._lock:
+            return self.lost.pop(chat_id, None) is not None
+
+    def drop_report(self, chat_id):
+        self.pop_report(chat_id)
+
+    def expire(self):
+        deadline = time.time() - self.ttl
+        with self._lock:
+            stale = [cid for cid, session in self.user_messages.items() if session.touched < deadline]
+            for cid in stale:
+                self._remove(cid)
+                self._mark_lost(cid)
+            # О потере напоминаем не дольше TTL
+            while self.lost and next(iter(self.lost.values())) < deadline:
+                self.lost.popitem(last=False)
+        return len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self.user_messages),
+                "items": sum(len(s.items) for s in self.user_messages.values()),
+                "bytes": self.total_bytes,
+            }
+
+class SQLiteSessionStore(SessionStore):
+    """Состояние в SQLite (WAL): общее для всех воркеров gunicorn и переживает перезапуск.
+
+    Сообщение отчёта считается добавленным только после COMMIT: «✅ Готово»
+    может попасть на другой воркер, и он должен увидеть все элементы.
+    Одновременные добавления из разных потоков записываются одной транзакцией
+    (групповой коммит): поток, получивший блокировку, записывает и чужие элементы.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS report_sessions (
+        chat_id INTEGER PRIMARY KEY,
+        user TEXT NOT NULL DEFAULT '{}',
+        date INTEGER,
+        items INTEGER NOT NULL DEFAULT 0,
+        text_bytes INTEGER NOT NULL DEFAULT 0,
+        updated REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_report_sessions_updated ON report_sessions(updated);
+    CREATE TABLE IF NOT EXISTS report_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        payload TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_report_items_chat ON report_items(chat_id, id);
+    CREATE TABLE IF NOT EXISTS admin_waiting (
+        admin_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        updated REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS lost_reports (
+        chat_id INTEGER PRIMARY KEY,
+        updated REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id INTEGER PRIMARY KEY,
+        ts REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_processed_updates_ts ON processed_updates(ts);
+    """
+
+    def __init__(self, path=SESSION_DB, ttl=SESSION_TTL, max_items=REPORT_MAX_ITEMS,
+                 max_text_bytes=REPORT_MAX_TEXT_BYTES):
+        super().__init__(ttl, max_items, max_text_bytes)
+        self.path = path
+        self._lock = threading.RLock()
+        self._pending_lock = threading.Lock()
+        self._pending = []  # [chat_id, payload, text_bytes, date, ts, результат] ждут записи
+        self._pid = None
+        self._conn = None
+        self._connect()
+
+    def _connect(self):
+        # Соединение и поток сброса создаются заново после fork
+        if self._pid == os.getpid():
+            return self._conn
+        with self._lock:
+            if self._pid != os.getpid():
+                self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.executescript(self.SCHEMA)
+                self._migrate(self._conn)
+                self._pending_lock = threading.Lock()
+                self._pending = []
+                self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _migrate(conn):
+        # Базы, созданные до появления квоты на объём текста
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(report_sessions)")}
+        if 'text_bytes' not in columns:
+            try:
+                conn.execute("ALTER TABLE report_sessions ADD COLUMN text_bytes INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass  # колонку уже добавил другой воркер
+
+    @contextmanager
+    def _tx(self):
+        conn = self._connect()
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def flush(self):
+        """Записывает ожидающие элементы одной транзакцией и проставляет им результат add_item."""
+        with self._lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            try:
+                with self._tx() as conn:
+                    results = [self._write_item(conn, *entry[:5]) for entry in pending]
+            except Exception as e:
+                for entry in pending:
+                    entry[5] = e
+                raise
+            for entry, result in zip(pending, results):
+                entry[5] = result
+
+    def _write_item(self, conn, chat_id, payload, text_bytes, date, ts):
+        # Счётчики и квоты проверяются в той же транзакции, что и вставка элемента
+        cur = conn.execute(
+            "UPDATE report_sessions SET items = items + 1, text_bytes = text_bytes + ?, updated = ?, "
+            "date = COALESCE(date, ?) WHERE chat_id = ? AND items < ? AND text_bytes + ? <= ?",
+            (text_bytes, ts, date, chat_id, self.max_items, text_bytes, self.max_text_bytes),
+        )
+        if cur.rowcount:
+            conn.execute("INSERT INTO report_items (chat_id, payload) VALUES (?, ?)", (chat_id, payload))
+            return True
+        if conn.execute("SELECT 1 FROM report_sessions WHERE chat_id = ?", (chat_id,)).fetchone():
+            return False
+        return None
+
+    def set_waiting(self, admin_id, user_id):
+        conn = self._connect()
+        with self._lock:
+            conn.execute(
+                "INSERT OR REPLACE INTO admin_waiting (admin_id, user_id, updated) VALUES (?, ?, ?)",
+                (admin_id, user_id, time.time()),
+            )
+
+    def pop_waiting(self, admin_id):
+        with self._tx() as conn:
+            row = conn.execute("SELECT user_id FROM admin_waiting WHERE admin_id = ?", (admin_id,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM admin_waiting WHERE admin_id = ?", (admin_id,))
+        return row[0] if row else None
+
+    def start_report(self, chat_id, user: dict):
+        self._ensure_sweeper()
+        self.flush()
+        with self._tx() as conn:
+            conn.execute("DELETE FROM report_items WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM lost_reports WHERE chat_id = ?", (chat_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO report_sessions (chat_id, user, date, items, updated) VALUES (?, ?, NULL, 0, ?)",
+                (chat_id, json.dumps(_compact_user(user), ensure_ascii=False), time.time()),
+            )
+
+    def add_item(self, chat_id, message: dict):
+        self._connect()
+        item = ReportItem.from_message(message)
+        entry = [chat_id, json.dumps(item.to_row(), ensure_ascii=False), item.text_bytes(),
+                 message.get('date'), time.time(), None]
+        with self._pending_lock:
+            self._pending.append(entry)
+        # Если элемент уже записал другой поток, flush ничего не найдёт и сразу вернётся
+        self.flush()
+        if isinstance(entry[5], Exception):
+            raise entry[5]
+        return entry[5]
+
+    def pop_report(self, chat_id):
+        self.flush()
+        with self._tx() as conn:
+            head = conn.execute("SELECT user, date FROM report_sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+            rows = conn.execute("SELECT payload FROM report_items WHERE chat_id = ? ORDER BY id", (chat_id,)).fetchall()
+            conn.execute("DELETE FROM report_items WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM report_sessions WHERE chat_id = ?", (chat_id,))
+        if not head:
+            return None
+        items = [ReportItem.from_row(json.loads(r[0])) for r in rows]
+        return ReportSession(json.loads(head[0]), head[1], items)
+
+    def has_report(self, chat_id):
+        conn = self._connect()
+        with self._lock:
+            return conn.execute("SELECT 1 FROM report_sessions WHERE chat_id = ?", (chat_id,)).fetchone() is not None
+
+    def is_lost(self, chat_id):
+        conn = self._connect()
+        with self._lock:
+            return conn.execute("SELECT 1 FROM lost_reports WHERE chat_id = ?", (chat_id,)).fetchone() is not None
+
+    def pop_lost(self, chat_id):
+        conn = self._connect()
+        with self._lock:
+            return conn.execute("DELETE FROM lost_reports WHERE chat_id = ?", (chat_id,)).rowcount == 1
+
+    def drop_report(self, chat_id):
+        self.pop_report(chat_id)
+
+    def expire(self):
+        self.flush()
+        deadline = time.time() - self.ttl
+        with self._tx() as conn:
+            conn.execute(
+                "DELETE FROM report_items WHERE chat_id IN (SELECT chat_id FROM report_sessions WHERE updated < ?)",
+                (deadline,),
+            )
+            conn.execute("DELETE FROM lost_reports WHERE updated < ?", (deadline,))
+            conn.execute(
+                "INSERT OR REPLACE INTO lost_reports (chat_id, updated) "
+                "SELECT chat_id, ? FROM report_sessions WHERE updated < ?",
+                (time.time(), deadline),
+            )
+            cur = conn.execute("DELETE FROM report_sessions WHERE updated < ?", (deadline,))
+            conn.execute("DELETE FROM processed_updates WHERE ts < ?", (time.time() - DEDUP_TTL,))
+        return cur.rowcount
+
+    def claim_update(self, update_id):
+        conn = self._connect()
+        with self._lock:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO processed_updates (update_id, ts) VALUES (?, ?)",
+                (update_id, time.time()),
+            )
+        return cur.rowcount == 1
+
+    def release_update(self, update_id):
+        conn = self._connect()
+        with self._lock:
+            conn.execute("DELETE FROM processed_updates WHERE update_id = ?", (update_id,))
+
+    def stats(self):
+        conn = self._connect()
+        with self._lock:
+            sessions, items = conn.execute("SELECT COUNT(*), COALESCE(SUM(items), 0) FROM report_sessions").fetchone()
+            nbytes = conn.execute("SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM report_items").fetchone()[0]
+        return {"sessions": sessions, "items": items, "bytes": nbytes}
+
+def create_session_store():
+    if SESSION_STORE == "sqlite":
+        return SQLiteSessionStore()
+    if SESSION_STORE != "memory":
+        print(f"[WARN] Невідомий SESSION_STORE={SESSION_STORE}, використовую memory")
+    return MemorySessionStore()
+
+sessions = create_session_store()
+
+# ====== Архив отчётов ======
+ARCHIVE_DB = os.getenv("ARCHIVE_DB", "archive.db").strip()
+ARCHIVE_FLUSH_INTERVAL = float(os.getenv("ARCHIVE_FLUSH_INTERVAL", "1.0"))
+ARCHIVE_PAGE_SIZE = int(os.getenv("ARCHIVE_PAGE_SIZE", "10"))
+
+class ReportArchive:
+    """Архив отправленных админу отчётов в SQLite (WAL) с полнотекстовым индексом FTS5.
+
+    add() только ставит отчёт в буфер — фоновый поток записывает накопленное
+    одной транзакцией раз в ARCHIVE_FLUSH_INTERVAL. Выборки идут от новых
+    к старым по курсору (id последнего показанного отчёта), без OFFSET.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER,
+        user TEXT NOT NULL DEFAULT '{}',
+        date INTEGER NOT NULL,
+        items TEXT NOT NULL,
+        body TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX IF NOT EXISTS idx_reports_user ON reports(user_id, id);
+    DROP INDEX IF EXISTS idx_reports_date;
+    CREATE INDEX IF NOT EXISTS idx_reports_day ON reports(date, id);
+    CREATE VIRTUAL TABLE IF NOT EXISTS reports_fts USING fts5(
+        body, content='reports', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS reports_fts_insert AFTER INSERT ON reports BEGIN
+        INSERT INTO reports_fts (rowid, body) VALUES (new.id, new.body);
+    END;
+    CREATE TRIGGER IF NOT EXISTS reports_fts_delete AFTER DELETE ON reports BEGIN
+        INSERT INTO reports_fts (reports_fts, rowid, body) VALUES ('delete', old.id, old.body);
+    END;
+    CREATE TABLE IF NOT EXISTS archive_queries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        mode TEXT NOT NULL,
+        arg TEXT NOT NULL,
+        created REAL NOT NULL
+    );
+    """
+    # Запросы для кнопки «Далі» хранятся сутки
+    QUERY_TTL = 24 * 3600
+
+    # Столбцы выборки; snippet() отмечает совпадения символами \x02 и \x03
+    COLUMNS = "reports.id, reports.chat_id, reports.user, reports.date, reports.items"
+
+    def __init__(self, path=ARCHIVE_DB, page_size=ARCHIVE_PAGE_SIZE):
+        self.path = path
+        self.page_size = page_size
+        self._lock = threading.RLock()
+        self._pending = []  # строки reports, ещё не записанные на диск
+        self._pid = None
+        self._conn = None
+        self.archived = 0
+
+    def _connect(self):
+        # Соединение и поток записи создаются заново после fork
+        if self._pid == os.getpid():
+            return self._conn
+        with self._lock:
+            if self._pid != os.getpid():
+                self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.executescript(self.SCHEMA)
+                self._pending = []
+                threading.Thread(target=self._flush_loop, name="archive-writer", daemon=True).start()
+                self._pid = os.getpid()
+        return self._conn
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(ARCHIVE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                cool_error_handler(e, context="ReportArchive.flush")
+
+    def add(self, chat_id, report: ReportSession):
+        """Ставит отчёт в очередь на запись (сам не обращается к диску)."""
+        self._connect()
+        body = "\n".join(item.caption for item in report.items if item.caption)
+        row = (
+            chat_id,
+            report.user.get('id'),
+            json.dumps(report.user, ensure_ascii=False),
+            int(report.date or time.time()),
+            json.dumps([item.to_row() for item in report.items], ensure_ascii=False),
+            body,
+        )
+        with self._lock:
+            self._pending.append(row)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT INTO reports (chat_id, user_id, user, date, items, body) VALUES (?, ?, ?, ?, ?, ?)",
+                    pending,
+                )
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            self.archived += len(pending)
+
+    # Условие курсора: id последнего показанного отчёта (первая страница — без ограничения)
+    _CURSOR = "reports.id < ?"
+    _FIRST_PAGE = 2 ** 63 - 1
+
+    def _page(self, sql, params, before):
+        """Возвращает (строки, курсор следующей страницы или None)."""
+        self.flush()
+        conn = self._connect()
+        with self._lock:
+            rows = conn.execute(sql, (*params, before or self._FIRST_PAGE, self.page_size + 1)).fetchall()
+        more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        return rows, (rows[-1][0] if more else None)
+
+    def search(self, query, before=None):
+        """Полнотекстовый поиск по тексту и подписям; слова ищутся по префиксу."""
+        terms = ['"{}"*'.format(word.replace('"', '""')) for word in query.split()]
+        if not terms:
+            return [], None
+        # Курсор и сортировка по rowid самой FTS-таблицы: индекс обходится с конца,
+        # snippet() считается только для строк страницы
+        sql = (
+            f"SELECT {self.COLUMNS}, snippet(reports_fts, 0, char(2), char(3), '…', 12) "
+            f"FROM reports_fts JOIN reports ON reports.id = reports_fts.rowid "
+            f"WHERE reports_fts MATCH ? AND reports_fts.rowid < ? ORDER BY reports_fts.rowid DESC LIMIT ?"
+        )
+        return self._page(sql, (" ".join(terms),), before)
+
+    def recent(self, user_id=None, day=None, before=None):
+        """Последние отчёты: все, одного пользователя или за день (datetime.date, UTC)."""
+        if day is not None:
+            return self._day(day, user_id, before)
+        where, params = [], []
+        if user_id is not None:
+            where.append("reports.user_id = ?")
+            params.append(user_id)
+        where.append(self._CURSOR)
+        sql = (
+            f"SELECT {self.COLUMNS}, substr(reports.body, 1, 120) FROM reports "
+            f"WHERE {' AND '.join(where)} ORDER BY reports.id DESC LIMIT ?"
+        )
+        return self._page(sql, params, before)
+
+    def _day(self, day, user_id, before):
+        # Отчёты за день идут по idx_reports_day (date, id) с конца: курсор id превращается
+        # в пару (date, id) и становится верхней границей диапазона индекса
+        start = int(datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc).timestamp())
+        upper = start + 86399
+        if before:
+            self.flush()
+            conn = self._connect()
+            with self._lock:
+                row = conn.execute("SELECT date FROM reports WHERE id = ?", (before,)).fetchone()
+            if row:
+                upper = min(upper, row[0])
+        where = ["reports.date >= ? AND reports.date <= ?"]
+        params = [start, upper]
+        if user_id is not None:
+            where.append("reports.user_id = ?")
+            params.append(user_id)
+        where.append("(reports.date, reports.id) < (?, ?)")
+        params.append(upper)
+        sql = (
+            f"SELECT {self.COLUMNS}, substr(reports.body, 1, 120) FROM reports INDEXED BY idx_reports_day "
+            f"WHERE {' AND '.join(where)} ORDER BY reports.date DESC, reports.id DESC LIMIT ?"
+        )
+        return self._page(sql, params, before)
+
+    def get(self, report_id):
+        """(chat_id, ReportSession) архивного отчёта или None."""
+        self.flush()
+        conn = self._connect()
+        with self._lock:
+            row = conn.execute("SELECT chat_id, user, date, items FROM reports WHERE id = ?", (report_id,)).fetchone()
+        if not row:
+            return None
+        items = [ReportItem.from_row(r) for r in json.loads(row[3])]
+        return row[0], ReportSession(json.loads(row[1]), row[2], items)
+
+    def save_query(self, mode, arg):
+        """Запоминает запрос постраничного просмотра; возвращает его короткий id для callback_data.
+
+        Хранится в той же базе — кнопку может обработать любой воркер.
+        """
+        conn = self._connect()
+        now = time.time()
+        with self._lock:
+            conn.execute("DELETE FROM archive_queries WHERE created < ?", (now - self.QUERY_TTL,))
+            cur = conn.execute("INSERT INTO archive_queries (mode, arg, created) VALUES (?, ?, ?)", (mode, arg, now))
+        return cur.lastrowid
+
+    def load_query(self, query_id):
+        """(режим, аргумент) сохранённого запроса или None, если он устарел."""
+        conn = self._connect()
+        with self._lock:
+            row = conn.execute("SELECT mode, arg FROM archive_queries WHERE id = ?", (query_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def close(self):
+        if self._pid == os.getpid():
+            try:
+                self.flush()
+            except Exception as e:
+                cool_error_handler(e, context="ReportArchive.close")
+
+archive = ReportArchive()
+atexit.register(archive.close)
+
+# ====== Защита от повторной доставки ======
+DEDUP_MAX = int(os.getenv("DEDUP_MAX", "10000"))
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", "3600"))
+DEDUP_SHARED = os.getenv("DEDUP_SHARED", "0").strip() == "1"
+
+class UpdateDeduplicator:
+    """Отбрасывает повторно доставленные Telegram update_id.
+
+    Последние ``maxlen`` id хранятся в кольцевом буфере (порядок) и множестве (поиск за O(1));
+    записи старше ``ttl`` секунд вытесняются. С ``store`` проверка дополнительно
+    идёт через общее хранилище сессий — так дубликат отсекается и на другом воркере.
+    """
+
+    def __init__(self, maxlen=DEDUP_MAX, ttl=DEDUP_TTL, store=None):
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self.store = store
+        self._ring = deque()
+        self._seen = set()
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def is_duplicate(self, update_id):
+        now = time.monotonic()
+        with self._lock:
+            ring = self._ring
+            while ring and (len(ring) >= self.maxlen or now - ring[0][1] > self.ttl):
+                self._seen.discard(ring.popleft()[0])
+            if update_id in self._seen:
+                self.suppressed += 1
+                return True
+            self._seen.add(update_id)
+            ring.append((update_id, now))
+        if self.store is not None and not self.store.claim_update(update_id):
+            with self._lock:
+                self.suppressed += 1
+            return True
+        return False
+
+    def forget(self, update_id):
+        """Убирает update_id, который не удалось принять: повторная доставка не будет дубликатом."""
+        with self._lock:
+            if update_id in self._seen:
+                self._seen.discard(update_id)
+                for i, (seen_id, _) in enumerate(self._ring):
+                    if seen_id == update_id:
+                        del self._ring[i]
+                        break
+        if self.store is not None:
+            self.store.release_update(update_id)
+
+dedup = UpdateDeduplicator(store=sessions if DEDUP_SHARED else None)
+
+# ====== Защита от флуда ======
+FLOOD_RATE_PER_MIN = float(os.getenv("FLOOD_RATE_PER_MIN", "60"))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "30"))
+FLOOD_NOTICE_INTERVAL = float(os.getenv("FLOOD_NOTICE_INTERVAL", "30"))
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", "500"))
+SHED_QUEUE_WAIT = float(os.getenv("SHED_QUEUE_WAIT", "5"))
+
+class FloodGuard:
+    """Ограничение входящих обновлений от одного чата: token bucket на chat_id
+    (FLOOD_RATE_PER_MIN в минуту, всплеск до FLOOD_BURST; 0 — без ограничения)."""
+
+    MAX_BUCKETS = 10000
+
+    def __init__(self, per_min=FLOOD_RATE_PER_MIN, burst=FLOOD_BURST, notice_interval=FLOOD_NOTICE_INTERVAL):
+        self.per_min = per_min
+        self.burst = burst
+        self.notice_interval = notice_interval
+        self._buckets = {}
+        self._notices = {}  # chat_id -> время последнего предупреждения
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def allow(self, chat_id):
+        if self.per_min <= 0:
+            return True
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_BUCKETS:
+                    self._buckets = {k: b for k, b in self._buckets.items() if not b.is_idle()}
+                bucket = self._buckets[chat_id] = TokenBucket(self.per_min / 60.0, self.burst)
+        if bucket.try_take():
+            return True
+        with self._lock:
+            self.limited += 1
+        return False
+
+    def notice_allowed(self, chat_id):
+        """Не чаще раза в notice_interval предупреждаем чат о лимите — иначе сам ответ становится флудом."""
+        now = time.monotonic()
+        with self._lock:
+            last = self._notices.get(chat_id)
+            if last is not None and now - last < self.notice_interval:
+                return False
+            if len(self._notices) >= self.MAX_BUCKETS:
+                self._notices = {k: t for k, t in self._notices.items() if now - t < self.notice_interval}
+            self._notices[chat_id] = now
+            return True
+
+flood = FloodGuard()
+
+class AdmissionControl:
+    """Допуск входящих обновлений до обработки.
+
+    Обновления админа (ответы, кнопки «✉️ Відповісти», команды) принимаются всегда.
+    Остальные отбрасываются (webhook всё равно отвечает 200), если очередь
+    обработки длиннее SHED_QUEUE_DEPTH или ожидание в ней дольше SHED_QUEUE_WAIT
+    секунд, а также когда чат превысил лимит FloodGuard. Очередь — диспетчер
+    обновлений, в асинхронном режиме — AsyncOutbox.
+    """
+
+    def __init__(self, guard, max_depth=SHED_QUEUE_DEPTH, max_wait=SHED_QUEUE_WAIT):
+        self.guard = guard
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        self.overloaded = False
+        self.shed = 0
+
+    def admit(self, chat_id, depth, wait=0.0):
+        if chat_id == ADMIN_ID:
+            return True
+        # Гистерезис: из перегрузки выходим, когда очередь опустится ниже половины порогов
+        scale = 0.5 if self.overloaded else 1.0
+        overloaded = bool((self.max_depth and depth >= self.max_depth * scale)
+                          or (self.max_wait and depth and wait >= self.max_wait * scale))
+        if overloaded != self.overloaded:
+            self.overloaded = overloaded
+            if overloaded:
+                MainProtokol(f"Перевантаження (черга {depth}, очікування {wait:.1f} с): відкидаю оновлення", ts='WARN')
+            else:
+                MainProtokol(f"Навантаження знизилось, відкинуто оновлень: {self.shed}")
+        if overloaded:
+            self.shed += 1
+            return False
+        if not self.guard.allow(chat_id):
+            if chat_id is not None and self.guard.notice_allowed(chat_id):
+                outbox.submit(chat_id, send_message, chat_id, "⚠️ Забагато повідомлень. Зачекайте трохи і спробуйте знову.")
+            return False
+        return True
+
+admission = AdmissionControl(flood)
+
+# ====== Запись трафика ======
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "").strip()  # пусто — запись выключена
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", str(50 * 1024 * 1024)))
+CAPTURE_BACKUP_COUNT = int(os.getenv("CAPTURE_BACKUP_COUNT", "10"))
+CAPTURE_SALT = os.getenv("CAPTURE_SALT", "").strip()
+
+class UpdateScrubber:
+    """Копия update без персональных данных для записи трафика.
+
+    Работает по списку разрешённого: остаются только структурные поля
+    (KEEP_KEYS — типы, даты, message_id, media_group_id, размеры и длины),
+    вложенные объекты и списки. Тексты и подписи заменяются строкой той же
+    длины (кнопки и команды бота остаются как есть), id пользователей и
+    чатов — стабильными псевдонимами (HMAC с солью), ADMIN_ID — маркером
+    "ADMIN", file_id и прочие строковые id — хешем. Все остальные значения
+    (имена, подписи пересылок, имена файлов, вопросы опросов, координаты,
+    телефоны и т.д.) отбрасываются.
+    """
+
+    ADMIN_MARKER = "ADMIN"
+    KEEP_KEYS = {
+        'update_id', 'message_id', 'message_thread_id', 'date', 'edit_date', 'media_group_id', 'type',
+        'is_bot', 'is_premium', 'is_topic_message', 'is_automatic_forward', 'has_protected_content',
+        'has_media_spoiler', 'width', 'height', 'duration', 'file_size', 'mime_type', 'offset', 'length',
+        'is_anonymous', 'allows_multiple_answers', 'is_closed', 'total_voter_count', 'voter_count',
+    }
+    ID_KEYS = {'id', 'user_id', 'chat_id'}
+    HASH_KEYS = {'id', 'file_id', 'file_unique_id', 'inline_message_id', 'chat_instance'}
+    TEXT_KEYS = {'text', 'caption'}
+
+    def __init__(self, salt):
+        self.salt = salt.encode('utf-8')
+
+    def pseudonym(self, value):
+        if value == ADMIN_ID:
+            return self.ADMIN_MARKER
+        digest = hmac.new(self.salt, str(abs(value)).encode(), hashlib.sha256).hexdigest()
+        pseudo = int(digest[:12], 16)
+        return -pseudo if value < 0 else pseudo
+
+    def _hash(self, value):
+        return hmac.new(self.salt, value.encode('utf-8'), hashlib.sha1).hexdigest()[:16]
+
+    def _text(self, text):
+        if text in TEXT_COMMANDS:
+            return text
+        command, sep, rest = text.partition(' ')
+        if command in ADMIN_COMMANDS:
+            return command + sep + 'x' * len(rest)
+        return 'x' * len(text)
+
+    def _callback_data(self, data):
+        prefix, sep, arg = data.partition('_')
+        if prefix not in CALLBACK_HANDLERS:
+            return 'x' * len(data)
+        if prefix == 'reply' and arg.lstrip('-').isdigit():
+            return f"reply_{self.pseudonym(int(arg))}"
+        return prefix + sep + 'x' * len(arg)
+
+    _DROP = object()
+
+    def _scalar(self, key, value):
+        if isinstance(value, bool) or value is None:
+            return value if key in self.KEEP_KEYS else self._DROP
+        if key in self.ID_KEYS and isinstance(value, int):
+            return self.pseudonym(value)
+        if isinstance(value, str):
+            if key in self.TEXT_KEYS:
+                return self._text(value)
+            if key == 'data':
+                return self._callback_data(value)
+            if key in self.HASH_KEYS:
+                return self._hash(value)
+        if key in self.KEEP_KEYS and isinstance(value, (int, str)):
+            return value
+        return self._DROP
+
+    def scrub(self, value, key=None):
+        if isinstance(value, dict):
+            out = {}
+            for k, v in value.items():
+                v = self.scrub(v, k)
+                if v is not self._DROP:
+                    out[k] = v
+            return out
+        if isinstance(value, list):
+            items = [self.scrub(v, key) for v in value]
+            return [v for v in items if v is not self._DROP]
+        return self._scalar(key, value)
+
+class TrafficCapture:
+    """Пишет обезличенные входящие update в JSONL: {"t": unix-время, "update": {...}}.
+
+    Запись идёт через AsyncLogWriter — ротация по CAPTURE_MAX_BYTES со сжатием
+    старых сегментов; для воспроизведения см. tools/replay.py.
+    """
+
+    def __init__(self, path, salt):
+        self.scrubber = UpdateScrubber(salt)
+        self.log = AsyncLogWriter(path, max_bytes=CAPTURE_MAX_BYTES, rotate_interval=0,
+                                  backup_count=CAPTURE_BACKUP_COUNT)
+        self.recorded = 0
+
+    def record(self, update: dict):
+        try:
+            line = json.dumps({"t": round(time.time(), 4), "update": self.scrubber.scrub(update)}, ensure_ascii=False)
+            self.log.write(line + "\n")
+            self.recorded += 1
+        except Exception as e:
+            cool_error_handler(e, context="TrafficCapture.record")
+
+# Соль по умолчанию выводится из токена: псевдонимы совпадают у всех воркеров и между перезапусками
+capture = TrafficCapture(CAPTURE_FILE, CAPTURE_SALT or hashlib.sha256(f"capture:{TOKEN}".encode()).hexdigest()) \
+    if CAPTURE_FILE else None
+if capture is not None:
+    atexit.register(capture.log.close)
+
+# ====== Flask App ======
+app = Flask(__name__)
+
+@app.errorhandler(Exception)
+def flask_global_error_handler(e):
+    cool_error_handler(e, context="Flask global error handler")
+    return "Внутрішня помилка сервера.", 500
+
+# ====== Обработка обновлений ======
+def handle_reply_callback(call: dict, arg: str):
+    """Кнопка «✉️ Відповісти» у админа: следующее сообщение админа уйдёт пользователю"""
+    if call['from']['id'] != ADMIN_ID:
+        return
     try:
-        threading.Thread(target=time_debugger, daemon=True).start()
+        user_id = int(arg)
+        sessions.set_waiting(ADMIN_ID, user_id)
+        outbox.submit(
+            ADMIN_ID, send_message, ADMIN_ID,
+            f"✍️ Введіть відповідь для користувача {user_id} (текст або файл):"
+        )
     except Exception as e:
-        cool_error_handler(e, context="main: start time_debugger")
-    
+        cool_error_handler(e, context="webhook: callback_query reply_")
+        MainProtokol(str(e), 'Помилка callback reply')
+
+def handle_start(message: dict, chat_id, from_id):
+    outbox.submit(chat_id, send_chat_action, chat_id, 'typing')
+    user = message.get('from', {})
+    welcome = build_welcome_message(user)
+    outbox.submit(
+        chat_id, send_message, chat_id,
+        welcome,
+        reply_markup=get_reply_buttons(),
+        parse_mode='HTML'
+    )
+
+def handle_report_start(message: dict, chat_id, from_id):
+    # Инициализируем сбор сообщений
+    sessions.start_report(chat_id, message.get('from') or {})
+    outbox.submit(
+        chat_id, send_message, chat_id,
+        "📝 Надсилайте вашу інформацію (текст, фото, відео, документи).\n\n"
+        "Натисніть 'Готово' коли закінчите.",
+        reply_markup=REPORT_KEYBOARD
+    )
+
+REPORT_LOST_TEXT = ("⚠️ Ваш звіт не збережено: сесія застаріла або сервер був перевантажений. "
+                    "Натисніть 📝 Повідомити про подію і надішліть інформацію ще раз.")
+
+def handle_report_done(message: dict, chat_id, from_id):
+    acks.cancel(chat_id)
+    report = sessions.pop_report(chat_id)
+    if report is None and sessions.pop_lost(chat_id):
+        outbox.submit(chat_id, send_message, chat_id, REPORT_LOST_TEXT, reply_markup=get_reply_buttons())
+        return
+    outbox.submit(chat_id, send_message, chat_id, "✅ Дякуємо! Ваша інформація відправлена адміністратору.", reply_markup=get_reply_buttons())
+
+    # Отправляем собранное админу в фоне (в очереди чата админа)
+    if report and report.items:
+        archive.add(chat_id, report)
+        outbox.submit(ADMIN_ID, send_report_to_admin, chat_id, report)
+
+def handle_report_cancel(message: dict, chat_id, from_id):
+    acks.cancel(chat_id)
+    outbox.submit(chat_id, send_message, chat_id, "❌ Скасовано.", reply_markup=get_reply_buttons())
+    sessions.drop_report(chat_id)
+
+def handle_collect(message: dict, chat_id, from_id):
+    # Собираем все остальные сообщения
+    if from_id == ADMIN_ID:
+        return
+    added = sessions.add_item(chat_id, message)
+    if added:
+        acks.add(chat_id)
+    elif added is None and sessions.is_lost(chat_id) and flood.notice_allowed(('lost', chat_id)):
+        outbox.submit(chat_id, send_message, chat_id, REPORT_LOST_TEXT, reply_markup=get_reply_buttons())
+    elif added is False and flood.notice_allowed(('quota', chat_id)):
+        outbox.submit(
+            chat_id, send_message, chat_id,
+            f"⚠️ Досягнуто ліміт звіту ({REPORT_MAX_ITEMS} повідомлень або "
+            f"{REPORT_MAX_TEXT_BYTES // 1024} КБ тексту). Натисніть ✅ Готово.",
+            reply_markup=REPORT_KEYBOARD
+        )
+
+def handle_profile_command(message: dict, args: str):
+    """/profile [секунды] — запускает сэмплирующий профайлер"""
+    try:
+        seconds = min(max(float(args or 30), 1), 600)
+    except ValueError:
+        seconds = 30
+    if profiler.start(seconds):
+        text = f"⏱ Профілювання запущено на {seconds:.0f} с, результат у {PROFILE_DIR}/"
+    else:
+        text = "⏱ Профілювання вже виконується."
+    outbox.submit(ADMIN_ID, send_message, ADMIN_ID, text)
+
+def handle_search_command(message: dict, args: str):
+    """/search <слова> — полнотекстовый поиск по архиву отчётов"""
+    if not args:
+        outbox.submit(ADMIN_ID, send_message, ADMIN_ID, "🔎 Використання: /search <слова>")
+        return
+    outbox.submit(ADMIN_ID, send_archive_page, 's', args)
+
+def handle_reports_command(message: dict, args: str):
+    """/reports [user_id | YYYY-MM-DD] — последние отчёты из архива"""
+    if not args:
+        outbox.submit(ADMIN_ID, send_archive_page, 'a', '')
+    elif args.lstrip('-').isdigit():
+        outbox.submit(ADMIN_ID, send_archive_page, 'u', args)
+    else:
+        try:
+            datetime.date.fromisoformat(args)
+        except ValueError:
+            outbox.submit(ADMIN_ID, send_message, ADMIN_ID, "🗂 Використання: /reports [user_id | РРРР-ММ-ДД]")
+            return
+        outbox.submit(ADMIN_ID, send_archive_page, 'd', args)
+
+def handle_report_command(message: dict, args: str):
+    """/report <номер> — повторно присылает архивный отчёт целиком"""
+    if not args.isdigit():
+        outbox.submit(ADMIN_ID, send_message, ADMIN_ID, "🗂 Використання: /report <номер>")
+        return
+    outbox.submit(ADMIN_ID, resend_archived_report, int(args))
+
+def handle_archive_callback(call: dict, arg: str):
+    """Кнопка «Далі ▶» под страницей архива: arch_<id запроса>_<курсор>"""
+    if call['from']['id'] != ADMIN_ID:
+        return
     try:
-        print(f"\n[INFO] Запуск Flask на 0.0.0.0:{PORT}")
-        app.run(host="0.0.0.0", port=PORT, debug=False)
+        query_id, _, cursor = arg.partition('_')
+        message_id = (call.get('message') or {}).get('message_id')
+        outbox.submit(ADMIN_ID, send_archive_next_page, int(query_id), int(cursor), message_id)
     except Exception as e:
-        cool_error_handler(e, context="main: app.run")
+        cool_error_handler(e, context="webhook: callback_query arch_")
+
+# Текстовые команды и кнопки -> обработчик (message, chat_id, from_id)
+TEXT_COMMANDS = {
+    '/start': handle_start,
+    "📝 Повідомити про подію": handle_report_start,
+    "✅ Готово": handle_report_done,
+    "❌ Скасувати": handle_report_cancel,
+}
+
+# Команды админа с аргументами -> обработчик (message, аргументы)
+ADMIN_COMMANDS = {
+    '/profile': handle_profile_command,
+    '/search': handle_search_command,
+    '/reports': handle_reports_command,
+    '/report': handle_report_command,
+}
+
+# Префикс callback_data -> обработчик (callback_query, остаток callback_data)
+CALLBACK_HANDLERS = {
+    'reply': handle_reply_callback,
+    'arch': handle_archive_callback,
+}
+
+def update_chat_id(update: dict):
+    """chat_id, по которому update попадает в свою очередь диспетчера"""
+    if 'callback_query' in update:
+        return (update['callback_query'].get('from') or {}).get('id')
+    message = update.get('message') or {}
+    return (message.get('chat') or {}).get('id')
+
+def update_kind(update: dict):
+    """Тип update для метрик: callback, command, text, media или other"""
+    if 'callback_query' in update:
+        return 'callback'
+    message = update.get('message')
+    if not message:
+        return 'other'
+    if 'text' in message:
+        return 'command' if message['text'] in TEXT_COMMANDS else 'text'
+    return 'media'
+
+def process_update(update: dict):
+    """Обрабатывает один update Telegram (общая логика для webhook и long polling)"""
+    # CALLBACK HANDLING
+    if 'callback_query' in update:
+        call = update['callback_query']
+        prefix, _, arg = (call.get('data') or '').partition('_')
+        handler = CALLBACK_HANDLERS.get(prefix)
+        if handler:
+            handler(call, arg)
+        return
+
+    # MESSAGE HANDLING
+    if 'message' in update:
+        message = update['message']
+        chat_id = (message.get('chat') or {}).get('id')
+        from_id = (message.get('from') or {}).get('id')
+
+        # Ответ администратора пользователю
+        if from_id == ADMIN_ID:
+            user_to_send = sessions.pop_waiting(ADMIN_ID)
+            if user_to_send is not None:
+                outbox.submit(ADMIN_ID, deliver_admin_reply, user_to_send, message)
+                return
+
+            # Команды админа
+            command, _, args = message.get('text', '').partition(' ')
+            admin_handler = ADMIN_COMMANDS.get(command)
+            if admin_handler:
+                admin_handler(message, args.strip())
+                return
+
+        handler = TEXT_COMMANDS.get(message.get('text', ''), handle_collect)
+        handler(message, chat_id, from_id)
+
+# ====== Диспетчер обновлений ======
+DISPATCH_LANES = int(os.getenv("DISPATCH_LANES", "8"))
+DISPATCH_QUEUE_MAX = int(os.getenv("DISPATCH_QUEUE_MAX", "1000"))
+
+class UpdateDispatcher:
+    """Распределяет обновления по ``lanes`` потокам-очередям по chat_id.
+
+    Обновления одного чата всегда попадают в одну очередь и обрабатываются
+    по порядку; разные чаты обрабатываются параллельно. У чата ``priority``
+    (админа) своя отдельная очередь, которую не задерживают пользователи.
+    Повторные update_id отбрасываются до постановки в очередь, остальные
+    проходят через AdmissionControl.
+    """
+
+    def __init__(self, lanes=DISPATCH_LANES, max_queue=DISPATCH_QUEUE_MAX, priority=None):
+        self.lanes = lanes
+        self.max_queue = max_queue
+        self.priority = priority
+        self._queues = []
+        self._priority_queue = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.dropped = 0
+        self.queue_wait = 0.0  # сглаженное ожидание в очереди, сек
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queues = [queue.Queue(maxsize=self.max_queue) for _ in range(self.lanes + 1)]
+            self._priority_queue = self._queues[-1]
+            for i, q in enumerate(self._queues):
+                name = "dispatch-priority" if q is self._priority_queue else f"dispatch-{i}"
+                threading.Thread(target=self._run_lane, args=(q,), name=name, daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, update: dict, block=False, trace=None):
+        """Ставит update в очередь его чата; False, если очередь переполнена."""
+        update_id = update.get('update_id')
+        if update_id is not None and dedup.is_duplicate(update_id):
+            return True
+        self._ensure_started()
+        chat_id = update_chat_id(update)
+        if not admission.admit(chat_id, self.depth(), self.queue_wait):
+            return True
+        if trace is None and TRACE_ENABLED:
+            trace = UpdateTrace(update_id)
+        elif trace is not None:
+            trace.update_id = update_id
+            trace.hold()
+        if chat_id is not None and chat_id == self.priority:
+            q = self._priority_queue
+        else:
+            q = self._queues[hash(chat_id) % self.lanes]
+        try:
+            q.put((update, trace, time.monotonic()), block=block)
+        except queue.Full:
+            if trace is not None:
+                trace.release()
+            if update_id is not None:
+                dedup.forget(update_id)
+            self.dropped += 1
+            MainProtokol(f"Черга диспетчера переповнена, update {update_id} відкинуто", ts='WARN')
+            return False
+        return True
+
+    def _run_lane(self, q):
+        while True:
+            update, trace, enqueued = q.get()
+            if q is not self._priority_queue:
+                self.queue_wait = 0.8 * self.queue_wait + 0.2 * (time.monotonic() - enqueued)
+            started = time.perf_counter()
+            token = watchdog.begin(f"update {update.get('update_id')} ({update_kind(update)})")
+            try:
+                if trace is None:
+                    process_update(update)
+                else:
+                    with use_trace(trace), trace_span("dispatch"):
+                        process_update(update)
+            except Exception as e:
+                cool_error_handler(e, context="dispatcher: process_update")
+                MainProtokol(str(e), 'Помилка webhook')
+            finally:
+                watchdog.end(token)
+                UPDATE_LATENCY.observe(time.perf_counter() - started, update_kind(update))
+                q.task_done()
+
+    def depth(self):
+        """Обновлений в очередях пользователей (очередь админа не считается)."""
+        return sum(q.qsize() for q in self._queues if q is not self._priority_queue)
+
+    def wait_idle(self, timeout=None):
+        """Ждёт, пока все принятые обновления будут обработаны."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for q in list(self._queues):
+            with q.all_tasks_done:
+                while q.unfinished_tasks:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    q.all_tasks_done.wait(remaining)
+        return True
+
+dispatcher = UpdateDispatcher(priority=ADMIN_ID)
+
+# Время от начала импорта до первого обработанного /webhook
+cold_start_seconds = None
+
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    global cold_start_seconds
+    started = time.perf_counter()
+    if cold_start_seconds is None:
+        cold_start_seconds = time.monotonic() - BOOT_STARTED
+        MainProtokol(f"Перший запит через {cold_start_seconds:.3f} с після старту")
+    trace = UpdateTrace() if TRACE_ENABLED else None
+    try:
+        if trace is None:
+            update = json.loads(request.get_data(as_text=True))
+            if capture is not None:
+                capture.record(update)
+            accepted = dispatcher.submit(update)
+        else:
+            with use_trace(trace):
+                with trace_span("decode"):
+                    update = json.loads(request.get_data(as_text=True))
+                if capture is not None:
+                    capture.record(update)
+                accepted = dispatcher.submit(update, trace=trace)
+        if not accepted:
+            # Очередь чата переполнена — Telegram повторит доставку позже
+            return "busy", 503
+        return "ok", 200
+
+    except Exception as e:
+        cool_error_handler(e, context="webhook - outer")
+        MainProtokol(str(e), 'Помилка webhook')
+        return "ok", 200
+    finally:
+        WEBHOOK_LATENCY.observe(time.perf_counter() - started)
+
+# Значения, которые считаются только при чтении /metrics
+metrics.gauge_func("bot_active_sessions", "Отчёты в процессе сбора", lambda: sessions.stats()["sessions"])
+metrics.gauge_func("bot_buffered_items", "Сообщений в незавершённых отчётах", lambda: sessions.stats()["items"])
+metrics.gauge_func("bot_outbox_depth", "Заданий в очереди исходящих", lambda: outbox.depth())
+metrics.gauge_func("bot_outbox_dropped_total", "Отброшено заданий outbox", lambda: outbox.dropped, kind="counter")
+metrics.gauge_func("bot_dispatcher_depth", "Обновлений в очередях диспетчера", lambda: dispatcher.depth())
+metrics.gauge_func("bot_dispatcher_dropped_total", "Отброшено обновлений диспетчером", lambda: dispatcher.dropped, kind="counter")
+metrics.gauge_func("bot_updates_shed_total", "Отброшено при перегрузке", lambda: admission.shed, kind="counter")
+metrics.gauge_func("bot_updates_flood_limited_total", "Отброшено лимитом на чат", lambda: flood.limited, kind="counter")
+metrics.gauge_func("bot_dispatcher_queue_wait_seconds", "Сглаженное ожидание в очереди диспетчера", lambda: round(dispatcher.queue_wait, 4))
+metrics.gauge_func("bot_duplicate_updates_total", "Отброшено повторных update_id", lambda: dedup.suppressed, kind="counter")
+metrics.gauge_func("telegram_api_throttled_total", "Ответы 429 от Bot API", lambda: tg.throttled, kind="counter")
+metrics.gauge_func("telegram_api_rate_wait_seconds_total", "Ожидание в ограничителе частоты", lambda: round(tg.rate_wait_total, 3), kind="counter")
+metrics.gauge_func(
+    "telegram_api_connections_total", "Соединения пула: opened/reused",
+    lambda: {(k.split("_", 1)[1],): v for k, v in tg.connection_stats().items() if k.startswith("connections_")},
+    labels=("state",), kind="counter")
+metrics.gauge_func("bot_startup_seconds", "Импорт модуля до готовности приложения", lambda: startup_seconds)
+metrics.gauge_func("bot_cold_start_seconds", "Старт до первого /webhook", lambda: cold_start_seconds if cold_start_seconds is not None else "NaN")
+metrics.gauge_func("bot_stalls_total", "Заданий, превысивших дедлайн сторожа", lambda: watchdog.stalls, kind="counter")
+metrics.gauge_func("bot_inflight_tasks", "Выполняющихся обработчиков и заданий outbox", lambda: watchdog.inflight())
+metrics.gauge_func("bot_oldest_inflight_seconds", "Самое долгое выполняющееся задание", lambda: round(watchdog.oldest(), 3))
+metrics.gauge_func("bot_healthy", "1 — нет зависаний (см. /healthz)", lambda: int(watchdog.healthy()))
+metrics.gauge_func("bot_log_dropped_total", "Отброшено записей лога", lambda: main_log.dropped + error_log.dropped, kind="counter")
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Методы для повторной отправки по file_id (у голосовых подпись не передаём, как и раньше)
+_RESEND_METHODS = {
+    'photo': 'sendPhoto',
+    'video': 'sendVideo',
+    'animation': 'sendAnimation',
+    'document': 'sendDocument',
+    'audio': 'sendAudio',
+    'voice': 'sendVoice',
+    'video_note': 'sendVideoNote',
+    'sticker': 'sendSticker',
+}
+_CAPTION_KINDS = ('photo', 'video', 'animation', 'document', 'audio')
+
+def send_collected_message(chat_id, item: ReportItem, from_chat_id=None):
+    """Отправляет собранное сообщение (фото, видео, текст и т.д.) админу"""
+    try:
+        method = _RESEND_METHODS.get(item.kind)
+        if method and item.file_id:
+            payload = {"chat_id": chat_id, item.kind: item.file_id}
+            if item.caption and item.kind in _CAPTION_KINDS:
+                payload["caption"] = escape(item.caption)
+            _post_request(method, data=payload)
+            return
+
+        if item.kind == 'text':
+            send_message(chat_id, f"<pre>{escape(item.caption or '')}</pre>", parse_mode="HTML")
+            return
+
+        # Остальные типы (геолокации, контакты и т.д.) копируем как есть
+        if from_chat_id is not None and item.message_id:
+            _post_request("copyMessage", data={
+                "chat_id": chat_id,
+                "from_chat_id": from_chat_id,
+                "message_id": item.message_id,
+            })
+
+    except Exception as e:
+        MainProtokol(f"Error sending collected message: {str(e)}", ts='ERROR')
+
+# copyMessages / forwardMessages принимают до 100 id за вызов
+BULK_COPY_LIMIT = 100
+REPORT_FLUSH_METHOD = os.getenv("REPORT_FLUSH_METHOD", "copyMessages").strip()
+
+# sendMediaGroup: 2–10 элементов; документы и аудио группируются только с себе подобными
+MEDIA_GROUP_LIMIT = 10
+_MEDIA_GROUP_CLASS = {'photo': 'visual', 'video': 'visual', 'document': 'document', 'audio': 'audio'}
+
+def _group_albums(items):
+    """Разбивает элементы на альбомы (списки для sendMediaGroup) и одиночные элементы по порядку."""
+    groups = []
+    for item in items:
+        cls = _MEDIA_GROUP_CLASS.get(item.kind)
+        last = groups[-1] if groups else None
+        if (cls and item.media_group_id and item.file_id and last and len(last) < MEDIA_GROUP_LIMIT
+                and last[0].media_group_id == item.media_group_id
+                and _MEDIA_GROUP_CLASS.get(last[0].kind) == cls):
+            last.append(item)
+        else:
+            groups.append([item])
+    return groups
+
+def send_collected_album(chat_id, items, from_chat_id=None):
+    """Отправляет элементы одного альбома одним sendMediaGroup"""
+    if len(items) < 2:
+        for item in items:
+            send_collected_message(chat_id, item, from_chat_id)
+        return
+    media = []
+    for item in items:
+        entry = {"type": item.kind, "media": item.file_id}
+        if item.caption:
+            entry["caption"] = escape(item.caption)
+        media.append(entry)
+    resp = _post_request("sendMediaGroup", data={"chat_id": chat_id, "media": json.dumps(media)})
+    if resp is None or not resp.ok:
+        for item in items:
+            send_collected_message(chat_id, item, from_chat_id)
+
+def send_collected_bulk(chat_id, from_chat_id, items):
+    """Копирует собранные сообщения админу пачками через copyMessages/forwardMessages.
+
+    Поддерживаются любые типы сообщений (стикеры, геолокации, кружки и т.д.),
+    альбомы Telegram сохраняет при копировании. Если пачка не прошла, альбомы
+    уходят через sendMediaGroup, остальное — по одному через send_collected_message.
+    """
+    # Telegram требует строго возрастающие message_id
+    items = sorted(items, key=lambda it: it.message_id or 0)
+    for i in range(0, len(items), BULK_COPY_LIMIT):
+        chunk = items[i:i + BULK_COPY_LIMIT]
+        resp = _post_request(REPORT_FLUSH_METHOD, data={
+            "chat_id": chat_id,
+            "from_chat_id": from_chat_id,
+            "message_ids": json.dumps([it.message_id for it in chunk]),
+        })
+        if resp is None or not resp.ok:
+            MainProtokol(f"{REPORT_FLUSH_METHOD} не вдалося, надсилаю {len(chunk)} повідомлень поштучно", ts='WARN')
+            for group in _group_albums(chunk):
+                send_collected_album(chat_id, group, from_chat_id)
+
+def send_report_to_admin(from_chat_id, report: ReportSession):
+    """Отправляет админу шапку из build_admin_info и все собранные сообщения по порядку"""
+    admin_info = build_admin_info(report.header_message())
+    reply_markup = _get_reply_markup_for_admin(report.user.get('id'))
+    send_message(ADMIN_ID, admin_info, reply_markup=reply_markup, parse_mode="HTML")
+    send_collected_bulk(ADMIN_ID, from_chat_id, report.items)
+
+def _archive_query(mode, arg, before=None):
+    """Запрос к архиву по режиму кнопки/команды; возвращает (заголовок, строки, курсор)."""
+    if mode == 's':
+        return (f"🔎 Пошук: {arg}", *archive.search(arg, before))
+    if mode == 'u':
+        return (f"🗂 Звіти користувача {arg}", *archive.recent(user_id=int(arg), before=before))
+    if mode == 'd':
+        return (f"🗂 Звіти за {arg}", *archive.recent(day=datetime.date.fromisoformat(arg), before=before))
+    return ("🗂 Останні звіти", *archive.recent(before=before))
+
+def build_archive_page(title, rows) -> str:
+    parts = [f"<b>{escape(title)}</b>", ""]
+    if not rows:
+        parts.append("Нічого не знайдено.")
+        return "\n".join(parts)
+    for report_id, chat_id, user_json, date, items_json, snippet in rows:
+        user = json.loads(user_json)
+        name = f"{user.get('first_name') or ''} {user.get('last_name') or ''}".strip() or "Без імені"
+        date_str = datetime.datetime.utcfromtimestamp(date).strftime('%Y-%m-%d %H:%M')
+        parts.append(
+            f"<b>#{report_id}</b> · {date_str} · {escape(name)} "
+            f"(<code>{user.get('id', chat_id)}</code>) · {len(json.loads(items_json))} повід."
+        )
+        if snippet:
+            snippet = escape(snippet.replace("\n", " ")).replace("\x02", "<u>").replace("\x03", "</u>")
+            parts.append(f"<i>{snippet}</i>")
+    parts.append("")
+    parts.append("Відкрити звіт: /report &lt;номер&gt;")
+    return "\n".join(parts)
+
+def send_archive_page(mode, arg, before=None, message_id=None, query_id=None):
+    """Отправляет админу страницу архива; со следующей страницы — редактирует то же сообщение"""
+    title, rows, cursor = _archive_query(mode, arg, before)
+    text = build_archive_page(title, rows)
+    markup = None
+    if cursor is not None:
+        # Сам запрос остаётся в архиве: в callback_data (до 64 байт) — только его id и курсор
+        if query_id is None:
+            query_id = archive.save_query(mode, arg)
+        markup = {"inline_keyboard": [[{"text": "Далі ▶", "callback_data": f"arch_{query_id}_{cursor}"}]]}
+    if message_id is None:
+        send_message(ADMIN_ID, text, reply_markup=markup, parse_mode="HTML")
+        return
+    payload = {"chat_id": ADMIN_ID, "message_id": message_id, "text": text, "parse_mode": "HTML"}
+    if markup:
+        payload["reply_markup"] = json.dumps(markup)
+    _post_request("editMessageText", data=payload)
+
+def send_archive_next_page(query_id, before, message_id=None):
+    query = archive.load_query(query_id)
+    if query is None:
+        send_message(ADMIN_ID, "🗂 Запит застарів — повторіть команду.")
+        return
+    mode, arg = query
+    send_archive_page(mode, arg, before, message_id, query_id)
+
+def resend_archived_report(report_id):
+    found = archive.get(report_id)
+    if found is None:
+        send_message(ADMIN_ID, f"🗂 Звіт #{report_id} не знайдено.")
+        return
+    send_report_to_admin(*found)
+
+def deliver_admin_reply(user_id, admin_msg: dict):
+    """Пересылает ответ админа пользователю и подтверждает результат админу"""
+    success = False
+    if user_id:
+        success = forward_admin_message_to_user(user_id, admin_msg)
+    if success:
+        send_message(ADMIN_ID, f"✅ Повідомлення надіслано користувачу {user_id}.", reply_markup=get_reply_buttons())
+    else:
+        send_message(ADMIN_ID, f"❌ Не вдалося надіслати повідомлення користувачу {user_id}.", reply_markup=get_reply_buttons())
+
+# Пробы платформы приходят часто — маршруты без обращений к диску
+@app.route('/', methods=['GET'])
+def index():
+    return "Бот працює ✅", 200
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    if watchdog.healthy():
+        return "ok", 200
+    return "stalled", 503
+
+# ====== Асинхронный режим (asyncio + aiohttp) ======
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_POOL_SIZE", "100"))
+
+class AsyncTelegramClient:
+    """Асинхронный клиент Bot API на aiohttp с пулом keep-alive соединений.
+
+    Использует тот же RateLimiter и ту же обработку 429, что и TelegramClient.
+    """
+
+    def __init__(self, token, base_url=TELEGRAM_API_BASE, pool_size=ASYNC_POOL_SIZE, limiter=None):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.limiter = limiter or RateLimiter()
+        self.session = None
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self.rate_wait_total = 0.0
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def call(self, method, params=None, timeout=None, **kwargs):
+        """Возвращает (HTTP-статус, разобранный JSON-ответ)."""
+        params = {k: str(v) for k, v in dict(params or {}, **kwargs).items() if v is not None}
+        url = f"{self.base_url}/bot{self.token}/{method}"
+        client_timeout = aiohttp.ClientTimeout(total=timeout or TELEGRAM_TIMEOUTS.get(method, TELEGRAM_DEFAULT_TIMEOUT))
+        limited = method not in RATE_EXEMPT_METHODS
+        chat_id = params.get('chat_id')
+        attempt = 0
+        while True:
+            if limited:
+                delay = self.limiter.reserve(chat_id)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    self.rate_wait_total += delay
+            self.calls += 1
+            started = time.perf_counter()
+            try:
+                async with self.session.post(url, data=params, timeout=client_timeout) as resp:
+                    status = resp.status
+                    data = await resp.json(content_type=None)
+            except Exception:
+                API_LATENCY.observe(time.perf_counter() - started, method, "error")
+                self.errors += 1
+                raise
+            API_LATENCY.observe(time.perf_counter() - started, method, status)
+            if status != 429 or attempt >= RATE_MAX_RETRIES:
+                return status, data
+            retry_after = float((data.get('parameters') or {}).get('retry_after', 1))
+            if retry_after > RATE_MAX_RETRY_AFTER:
+                return status, data
+            attempt += 1
+            self.throttled += 1
+            backoff = retry_after + random.uniform(0, 0.1 * retry_after + 0.05)
+            if limited:
+                self.limiter.pause(chat_id, backoff)
+            else:
+                await asyncio.sleep(backoff)
+
+async def async_post_request(method, data=None):
+    try:
+        status, result = await atg.call(method, data)
+        if status != 200:
+            MainProtokol(f"Request failed: {method} -> {status} {json.dumps(result, ensure_ascii=False)}", ts='WARN')
+        return status == 200
+    except Exception as e:
+        MainProtokol(f"Network error for {method}: {str(e)}", ts='ERROR')
+        return False
+
+async def async_send_message(chat_id, text, reply_markup=None, parse_mode=None, timeout=8):
+    payload = {'chat_id': chat_id, 'text': text}
+    if reply_markup:
+        payload['reply_markup'] = json.dumps(reply_markup)
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+    try:
+        status, result = await atg.call('sendMessage', payload, timeout=timeout)
+        if status != 200:
+            MainProtokol(json.dumps(result, ensure_ascii=False), 'Помилка надсилання')
+        return status == 200
+    except Exception as e:
+        cool_error_handler(e, context="async_send_message")
+        MainProtokol(str(e), 'Помилка мережі')
+        return False
+
+async def async_send_chat_action(chat_id, action='typing'):
+    try:
+        await atg.call('sendChatAction', chat_id=chat_id, action=action)
+    except Exception:
+        pass
+
+async def async_deliver_admin_reply(user_id, admin_msg: dict):
+    """Асинхронный аналог deliver_admin_reply (та же семантика forward_admin_message_to_user)"""
+    success = False
+    if user_id:
+        try:
+            method, payload = build_admin_reply_request(user_id, admin_msg)
+            await async_post_request(method, payload)
+            success = True
+        except Exception as e:
+            cool_error_handler(e, "forward_admin_message_to_user")
+    if success:
+        await async_send_message(ADMIN_ID, f"✅ Повідомлення надіслано користувачу {user_id}.", reply_markup=get_reply_buttons())
+    else:
+        await async_send_message(ADMIN_ID, f"❌ Не вдалося надіслати повідомлення користувачу {user_id}.", reply_markup=get_reply_buttons())
+
+async def async_send_report_to_admin(from_chat_id, report: ReportSession):
+    """Асинхронный аналог send_report_to_admin; запасной путь выполняется в пуле потоков"""
+    admin_info = build_admin_info(report.header_message())
+    reply_markup = _get_reply_markup_for_admin(report.user.get('id'))
+    await async_send_message(ADMIN_ID, admin_info, reply_markup=reply_markup, parse_mode="HTML")
+    items = sorted(report.items, key=lambda it: it.message_id or 0)
+    loop = asyncio.get_running_loop()
+    for i in range(0, len(items), BULK_COPY_LIMIT):
+        chunk = items[i:i + BULK_COPY_LIMIT]
+        ok = await async_post_request(REPORT_FLUSH_METHOD, {
+            "chat_id": ADMIN_ID,
+            "from_chat_id": from_chat_id,
+            "message_ids": json.dumps([it.message_id for it in chunk]),
+        })
+        if not ok:
+            MainProtokol(f"{REPORT_FLUSH_METHOD} не вдалося, надсилаю {len(chunk)} повідомлень поштучно", ts='WARN')
+            for group in _group_albums(chunk):
+                await loop.run_in_executor(None, send_collected_album, ADMIN_ID, group, from_chat_id)
+
+# Синхронная функция отправки -> асинхронный аналог; остальные выполняются в пуле потоков
+ASYNC_EQUIVALENTS = {
+    send_message: async_send_message,
+    send_chat_action: async_send_chat_action,
+    deliver_admin_reply: async_deliver_admin_reply,
+    send_report_to_admin: async_send_report_to_admin,
+}
+
+class AsyncOutbox:
+    """Замена Outbox для asyncio-режима с тем же интерфейсом submit().
+
+    Задания одного chat_id выстраиваются в цепочку задач и выполняются по порядку,
+    разные чаты — конкурентно в одном event loop. submit() можно вызывать
+    и из других потоков (например, из AckDebouncer). Задания чата ``priority``
+    принимаются и при переполнении.
+    """
+
+    def __init__(self, loop, max_depth=OUTBOX_MAX_DEPTH, priority=None):
+        self.loop = loop
+        self.max_depth = max_depth
+        self.priority = priority
+        self._loop_thread = threading.get_ident()
+        self._tails = {}
+        self._depth = 0
+        self.queue_wait = 0.0  # сглаженное ожидание задания до запуска, сек
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+
+    def submit(self, chat_id, fn, *args, **kwargs):
+        if threading.get_ident() != self._loop_thread:
+            self.loop.call_soon_threadsafe(self._submit, chat_id, fn, args, kwargs)
+            return True
+        return self._submit(chat_id, fn, args, kwargs)
+
+    def _submit(self, chat_id, fn, args, kwargs):
+        if self._depth >= self.max_depth and chat_id != self.priority:
+            self.dropped += 1
+            MainProtokol(f"Outbox переповнено, завдання для {chat_id} відкинуто", ts='WARN')
+            return False
+        self._depth += 1
+        self.submitted += 1
+        task = self.loop.create_task(self._run(self._tails.get(chat_id), fn, args, kwargs, time.monotonic()))
+        self._tails[chat_id] = task
+        task.add_done_callback(lambda t, cid=chat_id: self._tails.get(cid) is t and self._tails.pop(cid, None))
+        return True
+
+    async def _run(self, previous, fn, args, kwargs, submitted):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            self.queue_wait = 0.8 * self.queue_wait + 0.2 * (time.monotonic() - submitted)
+            afn = ASYNC_EQUIVALENTS.get(fn)
+            if afn is not None:
+                await afn(*args, **kwargs)
+            else:
+                await self.loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+        except Exception as e:
+            cool_error_handler(e, context=f"async outbox: {getattr(fn, '__name__', fn)}")
+        finally:
+            self._depth -= 1
+            self.completed += 1
+
+    def depth(self):
+        return self._depth
+
+    async def wait_idle(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._depth:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.01)
+        return True
+
+atg = None
+
+# С хранилищем в памяти обработчики только меняют состояние и ставят отправки в AsyncOutbox —
+# их можно выполнять прямо в event loop. С SQLite (сессии или общий dedup) запись может
+# ждать блокировку до 10 с, поэтому update обрабатывается в пуле потоков через AsyncOutbox
+ASYNC_INLINE_UPDATES = SESSION_STORE != "sqlite" and not DEDUP_SHARED
+
+def process_update_timed(update: dict):
+    t0 = time.perf_counter()
+    try:
+        process_update(update)
+    finally:
+        UPDATE_LATENCY.observe(time.perf_counter() - t0, update_kind(update))
+
+def process_new_update(update: dict):
+    """Проверка на повтор и обработка — целиком вне event loop."""
+    update_id = update.get('update_id')
+    if update_id is None or not dedup.is_duplicate(update_id):
+        process_update_timed(update)
+
+async def _async_webhook(request):
+    started = time.perf_counter()
+    try:
+        update = json.loads(await request.text())
+        if capture is not None:
+            capture.record(update)
+        chat_id = update_chat_id(update)
+        if ASYNC_INLINE_UPDATES:
+            update_id = update.get('update_id')
+            if ((update_id is None or not dedup.is_duplicate(update_id))
+                    and admission.admit(chat_id, outbox.depth(), outbox.queue_wait)):
+                process_update_timed(update)
+        elif admission.admit(chat_id, outbox.depth(), outbox.queue_wait):
+            # Очередь чата в AsyncOutbox сохраняет порядок: отправки, поставленные
+            # обработчиком, выполнятся после него
+            if not outbox.submit(chat_id, process_new_update, update):
+                return aiohttp.web.Response(text="busy", status=503)
+    except Exception as e:
+        cool_error_handler(e, context="async webhook")
+        MainProtokol(str(e), 'Помилка webhook')
+    finally:
+        WEBHOOK_LATENCY.observe(time.perf_counter() - started)
+    return aiohttp.web.Response(text="ok")
+
+async def _async_index(request):
+    return aiohttp.web.Response(text="Бот працює ✅")
+
+async def _async_healthz(request):
+    if watchdog.healthy():
+        return aiohttp.web.Response(text="ok")
+    return aiohttp.web.Response(text="stalled", status=503)
+
+async def _async_metrics(request):
+    return aiohttp.web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+def create_async_app():
+    """aiohttp-приложение с теми же маршрутами, что и Flask app."""
+    if aiohttp is None:
+        raise RuntimeError("BOT_MODE=async потребує пакет aiohttp")
+
+    async def on_startup(app):
+        global atg, outbox
+        atg = AsyncTelegramClient(TOKEN, limiter=tg.limiter)
+        await atg.start()
+        outbox = AsyncOutbox(asyncio.get_running_loop(), priority=ADMIN_ID)
+        # Подключение к архиву (создание схемы) — заранее и вне event loop
+        await asyncio.get_running_loop().run_in_executor(None, archive._connect)
+        app["watchdog"] = watchdog.watch_loop()
+
+    async def on_cleanup(app):
+        await outbox.wait_idle(10)
+        await atg.close()
+
+    app = aiohttp.web.Application()
+    app.router.add_post("/webhook", _async_webhook)
+    app.router.add_get("/", _async_index)
+    app.router.add_get("/healthz", _async_healthz)
+    app.router.add_get("/metrics", _async_metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def run_async():
+    print(f"\n[INFO] Запуск aiohttp на 0.0.0.0:{PORT}")
+    aiohttp.web.run_app(create_async_app(), host="0.0.0.0", port=PORT, print=None)
+
+# ====== Режим long polling ======
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+POLL_OFFSET_FILE = os.getenv("POLL_OFFSET_FILE", "poll_offset.txt").strip()
+# Сколько ждать обработки пачки, прежде чем опрашивать дальше (по умолчанию — шесть WATCHDOG_DEADLINE)
+POLL_BATCH_TIMEOUT = float(os.getenv("POLL_BATCH_TIMEOUT", str(WATCHDOG_DEADLINE * 6)))
+
+def _load_poll_offset():
+    try:
+        with open(POLL_OFFSET_FILE, 'r', encoding='utf-8') as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def _save_poll_offset(offset):
+    tmp = POLL_OFFSET_FILE + '.tmp'
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(str(offset))
+        os.replace(tmp, POLL_OFFSET_FILE)
+    except OSError as e:
+        cool_error_handler(e, context="save poll offset")
+
+def _poll_updates(offset):
+    resp = tg.call(
+        "getUpdates",
+        {"offset": offset, "limit": POLL_LIMIT, "timeout": POLL_TIMEOUT},
+        timeout=POLL_TIMEOUT + 10,
+    )
+    data = resp.json()
+    if not data.get('ok'):
+        raise RuntimeError(f"getUpdates failed: {resp.status_code} {data.get('description')}")
+    return data.get('result') or []
+
+def _dispatch_poll_batch(updates):
+    """Раздаёт пачку диспетчеру, ждёт её обработки и только потом сохраняет смещение.
+
+    Ожидание ограничено POLL_BATCH_TIMEOUT: зависший обработчик не должен
+    останавливать опрос. По истечении пишем WARN (и сообщаем админу при
+    ERROR_ALERT_ADMIN) и идём дальше — оставшиеся обновления дообработаются
+    из очередей диспетчера.
+    """
+    offset = updates[-1]['update_id'] + 1
+    token = watchdog.begin(f"getUpdates: пачка до {offset - 1}", POLL_BATCH_TIMEOUT)
+    try:
+        for update in updates:
+            if capture is not None:
+                capture.record(update)
+            dispatcher.submit(update, block=True)
+        if not dispatcher.wait_idle(POLL_BATCH_TIMEOUT):
+            text = f"Пачку getUpdates до {offset - 1} не оброблено за {POLL_BATCH_TIMEOUT:.0f} с, опитування продовжено"
+            MainProtokol(text, ts='WARN')
+            if ERROR_ALERT_ADMIN and error_stats.alert_allowed("poll-batch-timeout"):
+                _alert_admin(f"⚠️ {text}")
+    finally:
+        watchdog.end(token)
+    _save_poll_offset(offset)
+    return offset
+
+def run_polling():
+    """Получает обновления через getUpdates и передаёт их в диспетчер.
+
+    Запрос с новым offset подтверждает Telegram предыдущую пачку, поэтому он
+    уходит только после того, как пачка обработана (чаты внутри пачки
+    обрабатываются параллельно, но следующую пачку заранее не запрашиваем).
+    Смещение обработанной пачки сохраняется в POLL_OFFSET_FILE — после падения
+    необработанные обновления придут снова.
+
+    «Обработана» значит только, что отработал process_update: поставленные им
+    задания outbox и сессии MemorySessionStore живут в памяти процесса и при
+    падении теряются. Если пачка не обработана за POLL_BATCH_TIMEOUT, опрос
+    продолжается, и её хвост тоже подтверждается до обработки.
+    """
+    try:
+        # getUpdates не работает, пока установлен webhook
+        tg.call("deleteWebhook")
+        clear_webhook_markers()
+    except Exception as e:
+        cool_error_handler(e, context="run_polling: deleteWebhook")
+
+    offset = _load_poll_offset()
+    print(f"[INFO] Long polling: offset={offset}, limit={POLL_LIMIT}, timeout={POLL_TIMEOUT}")
+    backoff = 1
+    while True:
+        try:
+            updates = _poll_updates(offset)
+            backoff = 1
+        except Exception as e:
+            cool_error_handler(e, context="run_polling: getUpdates")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+            continue
+        if updates:
+            offset = _dispatch_poll_batch(updates)
+
+startup_seconds = time.monotonic() - BOOT_STARTED
+print(f"[INFO] Ініціалізація за {startup_seconds * 1000:.0f} ms")
+
+if __name__ == "__main__":
+    watchdog.start()
+
+    if PROFILE_ON_START > 0:
+        profiler.start(PROFILE_ON_START)
+    
+    if BOT_MODE == "polling":
+        try:
+            run_polling()
+        except Exception as e:
+            cool_error_handler(e, context="main: run_polling")
+    elif BOT_MODE == "async":
+        try:
+            run_async()
+        except Exception as e:
+            cool_error_handler(e, context="main: run_async")
+    else:
+        try:
+            print(f"\n[INFO] Запуск Flask на 0.0.0.0:{PORT}")
+            app.run(host="0.0.0.0", port=PORT, debug=False)
+        except Exception as e:
+            cool_error_handler(e, context="main: app.run")
@@ -0,0 +1,29 @@
+# Общие фикстуры: бот импортируется один раз, направленный на локальную заглушку Bot API
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "tools"))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from bench import ADMIN_ID, load_bot  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def api():
+    api = FakeBotAPI().start()
+    yield api
+    api.stop()
+
+
+@pytest.fixture(scope="session")
+def bot(api):
+    return load_bot(api, rate_limits=False)
+
+
+@pytest.fixture(scope="session")
+def admin_id():
+    return ADMIN_ID
@@ -0,0 +1,21 @@
+import time
+
+
+def test_ack_skipped_when_report_closed_elsewhere(bot, tmp_path, monkeypatch):
+    # Два воркера с общей SQLite: «✅ Готово» обработал второй, пока первый ждал тишины
+    path = str(tmp_path / "sessions.db")
+    first, second = bot.SQLiteSessionStore(path=path), bot.SQLiteSessionStore(path=path)
+    monkeypatch.setattr(bot, "sessions", first)
+    sent = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, **kw: sent.append((chat_id, text)))
+    acks = bot.AckDebouncer(window=0.05)
+
+    for chat_id in (501, 502):
+        first.start_report(chat_id, {'id': chat_id})
+        assert first.add_item(chat_id, {'message_id': 1, 'text': 'привіт'}) is True
+        acks.add(chat_id)
+    assert second.pop_report(501) is not None
+
+    time.sleep(0.3)
+    bot.outbox.wait_idle(5)
+    assert [chat_id for chat_id, text in sent if "Додано" in text] == [502]
@@ -0,0 +1,61 @@
+import pytest
+
+
+def text(message_id, value):
+    return {'message_id': message_id, 'text': value}
+
+
+@pytest.fixture
+def sent(bot, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, **kw: sent.append((chat_id, text)))
+    return sent
+
+
+def test_shedding_has_hysteresis(bot):
+    admission = bot.AdmissionControl(bot.FloodGuard(per_min=0), max_depth=10, max_wait=0)
+    assert admission.admit(1, 9)
+    assert not admission.admit(1, 10)  # включается на пороге
+    assert not admission.admit(1, 6)   # и держится до половины порога
+    assert admission.admit(1, 4)
+    assert not admission.overloaded and admission.shed == 2
+
+
+def test_shedding_by_queue_wait(bot):
+    admission = bot.AdmissionControl(bot.FloodGuard(per_min=0), max_depth=0, max_wait=1.0)
+    assert admission.admit(1, 3, wait=0.5)
+    assert not admission.admit(1, 3, wait=2.0)
+    assert not admission.admit(1, 3, wait=0.6)
+    assert admission.admit(1, 0, wait=2.0)  # пустая очередь — ожидание устарело
+
+
+def test_admin_admitted_under_overload_and_flood(bot, admin_id):
+    admission = bot.AdmissionControl(bot.FloodGuard(per_min=1, burst=1), max_depth=10, max_wait=1.0)
+    assert not admission.admit(1, 100, wait=60)
+    shed = admission.shed
+    assert all(admission.admit(admin_id, 100, wait=60) for _ in range(5))
+    assert admission.shed == shed
+
+
+def test_flood_notice_once_per_interval(bot, sent):
+    guard = bot.FloodGuard(per_min=60, burst=2, notice_interval=30)
+    admission = bot.AdmissionControl(guard, max_depth=0, max_wait=0)
+    assert [admission.admit(7, 0) for _ in range(5)] == [True, True, False, False, False]
+    bot.outbox.wait_idle(5)
+    assert guard.limited == 3
+    assert [chat_id for chat_id, text in sent if "Забагато" in text] == [7]
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_report_text_quota(bot, tmp_path, backend):
+    if backend == "memory":
+        store = bot.MemorySessionStore(max_text_bytes=10)
+    else:
+        store = bot.SQLiteSessionStore(path=str(tmp_path / "sessions.db"), max_text_bytes=10)
+    store.start_report(1, {'id': 1})
+    assert store.add_item(1, text(1, "пожежа")) is False  # 12 байт UTF-8
+    assert store.add_item(1, text(2, "дим")) is True       # 6 байт
+    assert store.add_item(1, text(3, "вогонь")) is False
+    assert store.add_item(1, text(4, "ой")) is True        # ровно 10
+    assert store.add_item(1, {'message_id': 5, 'photo': [{'file_id': 'f'}]}) is True
+    assert [item.caption for item in store.pop_report(1).items] == ["дим", "ой", None]
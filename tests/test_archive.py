@@ -0,0 +1,95 @@
+import datetime
+import json
+
+import pytest
+
+LONG_QUERY = "пожежа на вулиці Шевченка біля школи"
+
+
+@pytest.fixture
+def archive(bot, tmp_path, monkeypatch):
+    archive = bot.ReportArchive(path=str(tmp_path / "archive.db"), page_size=2)
+    monkeypatch.setattr(bot, "archive", archive)
+    return archive
+
+
+def add_report(bot, archive, chat_id, text):
+    item = bot.ReportItem('text', None, text, chat_id)
+    archive.add(chat_id, bot.ReportSession({'id': chat_id, 'first_name': f'U{chat_id}'}, 1700000000, [item]))
+
+
+def test_search_pages_by_cursor(bot, archive):
+    for i in range(5):
+        add_report(bot, archive, 100 + i, f"{LONG_QUERY} {i}")
+    add_report(bot, archive, 200, "бабуся біля будинку")  # совпадает только с префиксом «б»
+
+    seen = []
+    rows, cursor = archive.search(LONG_QUERY)
+    while True:
+        seen += [row[0] for row in rows]
+        if cursor is None:
+            break
+        rows, cursor = archive.search(LONG_QUERY, before=cursor)
+    assert seen == [5, 4, 3, 2, 1]
+
+
+def test_next_page_runs_the_same_query(bot, archive, admin_id, monkeypatch):
+    for i in range(3):
+        add_report(bot, archive, 100 + i, f"{LONG_QUERY} {i}")
+    for i in range(3):
+        add_report(bot, archive, 300 + i, "бабуся біля будинку")
+
+    sent = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, reply_markup=None, **kw: sent.append(
+        (text, reply_markup)))
+    monkeypatch.setattr(bot, "_post_request", lambda method, data=None, timeout=None: sent.append(
+        (data["text"], json.loads(data["reply_markup"]) if "reply_markup" in data else None)))
+
+    bot.send_archive_page('s', LONG_QUERY)
+    text, markup = sent[-1]
+    data = markup["inline_keyboard"][0][0]["callback_data"]
+    assert len(data.encode("utf-8")) <= 64
+    assert LONG_QUERY not in data and "#3" in text and "#2" in text
+
+    bot.handle_archive_callback({"from": {"id": admin_id}, "message": {"message_id": 9}}, data.partition("_")[2])
+    bot.outbox.wait_idle(5)
+    text, markup = sent[-1]
+    assert "#1" in text
+    assert "#4" not in text and "#5" not in text and "#6" not in text
+    assert markup is None
+
+
+def test_unknown_query_id(bot, archive, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, **kw: sent.append(text))
+    bot.send_archive_next_page(12345, 10)
+    assert "застарів" in sent[-1]
+
+
+def test_day_pages_walk_the_date_index(bot, archive):
+    day = datetime.date(2023, 11, 14)
+    start = int(datetime.datetime(2023, 11, 14, tzinfo=datetime.timezone.utc).timestamp())
+    for i, date in enumerate([start - 10, start + 50, start + 10, start + 86400, start + 30, start + 20]):
+        item = bot.ReportItem('text', None, f"звіт {i}", i)
+        archive.add(100 + i, bot.ReportSession({'id': 100 + i}, date, [item]))
+
+    statements = []
+    conn = archive._connect()
+    conn.set_trace_callback(statements.append)
+    try:
+        seen = []
+        rows, cursor = archive.recent(day=day)
+        while True:
+            seen += [row[0] for row in rows]
+            if cursor is None:
+                break
+            rows, cursor = archive.recent(day=day, before=cursor)
+    finally:
+        conn.set_trace_callback(None)
+    assert seen == [2, 5, 6, 3]  # по дате отчёта, от поздних к ранним
+
+    pages = [sql for sql in statements if "ORDER BY reports.date DESC" in sql]
+    assert len(pages) == 2
+    for sql in pages:
+        plan = " ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql))
+        assert "USING INDEX idx_reports_day" in plan and "TEMP B-TREE" not in plan
@@ -0,0 +1,61 @@
+# Асинхронный режим с SQLite: блокировка базы не должна останавливать event loop.
+# Отдельный процесс — create_async_app() подменяет глобальный outbox.
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = r"""
+import asyncio, json, os, sqlite3, sys, time
+sys.path.insert(0, os.path.join(os.environ["REPO"], "tools"))
+sys.path.insert(0, os.environ["REPO"])
+from fake_bot_api import FakeBotAPI
+api = FakeBotAPI().start()
+os.environ["TELEGRAM_API_BASE"] = api.base_url
+import bot
+from aiohttp.test_utils import TestClient, TestServer
+
+def msg(update_id, text):
+    return json.dumps({"update_id": update_id, "message": {"message_id": update_id, "date": 0,
+                       "chat": {"id": 5}, "from": {"id": 5}, "text": text}})
+
+async def main():
+    async with TestClient(TestServer(bot.create_async_app())) as c:
+        await c.post("/webhook", data=msg(1, "📝 Повідомити про подію"))
+        await bot.outbox.wait_idle(5)
+        # Другой процесс держит запись в базе сессий
+        lock = sqlite3.connect(bot.SESSION_DB, isolation_level=None)
+        lock.execute("BEGIN IMMEDIATE")
+        t0 = time.perf_counter()
+        await c.post("/webhook", data=msg(2, "✅ Готово"))
+        webhook = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        await c.get("/healthz")
+        probe = time.perf_counter() - t0
+        await asyncio.sleep(0.5)
+        lock.execute("COMMIT")
+        await bot.outbox.wait_idle(10)
+        print(json.dumps({"inline": bot.ASYNC_INLINE_UPDATES, "webhook": webhook, "probe": probe,
+                          "sessions": bot.sessions.stats()["sessions"], "calls": dict(api.calls)}))
+
+asyncio.run(main())
+"""
+
+
+def test_sqlite_lock_does_not_block_event_loop(tmp_path):
+    env = dict(os.environ, API_TOKEN="test:token", ADMIN_ID="1000", BOT_MODE="async", WEBHOOK_HOST="",
+               SESSION_STORE="sqlite", FLOOD_RATE_PER_MIN="0", ACK_QUIET_WINDOW="0.05", REPO=REPO_DIR)
+    out = subprocess.run([sys.executable, "-c", SCRIPT], cwd=str(tmp_path), env=env,
+                         capture_output=True, text=True, timeout=60)
+    assert out.returncode == 0, out.stderr
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    assert result["inline"] is False
+    assert result["webhook"] < 0.2
+    assert result["probe"] < 0.2
+    assert result["sessions"] == 0  # «Готово» обработано после снятия блокировки
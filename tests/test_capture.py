@@ -0,0 +1,99 @@
+import json
+
+SECRETS = [
+    "Іван", "Іваненко", "ivan_ua", "+380501234567", "Олена Петренко", "Редакція", "Коваль",
+    "паспорт_Іваненко.pdf", "Де зустрінемось?", "біля школи", "вул. Шевченка, 5", "https://t.me/secret",
+    "Пожежа на вулиці Шевченка", "Фото з місця події", "file-AAA", "uniq-BBB", "Канал Новини",
+]
+SECRET_NUMBERS = [50.4501, 30.5234, 777000111, 555000222, -100123456789]
+
+
+def full_update(admin_id):
+    user = {"id": 777000111, "is_bot": False, "first_name": "Іван", "last_name": "Іваненко",
+            "username": "ivan_ua", "language_code": "uk", "is_premium": True}
+    return {
+        "update_id": 42,
+        "message": {
+            "message_id": 7,
+            "date": 1700000000,
+            "media_group_id": "1357",
+            "chat": {"id": 777000111, "type": "private", "first_name": "Іван", "username": "ivan_ua"},
+            "from": user,
+            "sender_chat": {"id": -100123456789, "type": "channel", "title": "Канал Новини"},
+            "forward_sender_name": "Олена Петренко",
+            "forward_signature": "Редакція",
+            "author_signature": "Коваль",
+            "forward_origin": {"type": "hidden_user", "date": 1699999999, "sender_user_name": "Олена Петренко"},
+            "forward_from": {"id": 555000222, "first_name": "Олена Петренко"},
+            "caption": "Фото з місця події",
+            "caption_entities": [{"type": "text_link", "offset": 0, "length": 4, "url": "https://t.me/secret"},
+                                 {"type": "text_mention", "offset": 5, "length": 3, "user": user}],
+            "document": {"file_id": "file-AAA", "file_unique_id": "uniq-BBB",
+                         "file_name": "паспорт_Іваненко.pdf", "mime_type": "application/pdf", "file_size": 1024},
+            "photo": [{"file_id": "file-AAA", "file_unique_id": "uniq-BBB", "width": 90, "height": 90}],
+            "contact": {"phone_number": "+380501234567", "first_name": "Іван", "user_id": 777000111},
+            "location": {"latitude": 50.4501, "longitude": 30.5234},
+            "venue": {"location": {"latitude": 50.4501, "longitude": 30.5234},
+                      "title": "біля школи", "address": "вул. Шевченка, 5"},
+            "poll": {"id": "poll-1", "question": "Де зустрінемось?", "total_voter_count": 3,
+                     "options": [{"text": "біля школи", "voter_count": 2}]},
+            "text": "Пожежа на вулиці Шевченка",
+            "reply_markup": {"inline_keyboard": [[{"text": "Канал Новини", "url": "https://t.me/secret"}]]},
+        },
+    }
+
+
+def leaves(value):
+    if isinstance(value, dict):
+        for v in value.values():
+            yield from leaves(v)
+    elif isinstance(value, list):
+        for v in value:
+            yield from leaves(v)
+    else:
+        yield value
+
+
+def test_scrub_leaves_no_personal_data(bot, admin_id):
+    scrubber = bot.UpdateScrubber("salt")
+    update = full_update(admin_id)
+    original = json.dumps(update, ensure_ascii=False)
+    scrubbed = scrubber.scrub(update)
+    dumped = json.dumps(scrubbed, ensure_ascii=False)
+
+    assert json.dumps(update, ensure_ascii=False) == original  # исходный update не изменён
+    for secret in SECRETS:
+        assert secret not in dumped, secret
+    values = set(v for v in leaves(scrubbed) if not isinstance(v, bool))
+    for number in SECRET_NUMBERS:
+        assert number not in values, number
+
+
+def test_scrub_keeps_structure_and_lengths(bot, admin_id):
+    scrubber = bot.UpdateScrubber("salt")
+    scrubbed = scrubber.scrub(full_update(admin_id))
+    msg = scrubbed["message"]
+    assert scrubbed["update_id"] == 42
+    assert msg["message_id"] == 7 and msg["date"] == 1700000000 and msg["media_group_id"] == "1357"
+    assert len(msg["text"]) == len("Пожежа на вулиці Шевченка")
+    assert len(msg["caption"]) == len("Фото з місця події")
+    assert msg["chat"]["id"] == msg["from"]["id"] == scrubber.pseudonym(777000111)
+    assert msg["document"]["mime_type"] == "application/pdf"
+    assert "file_name" not in msg["document"]
+    assert msg["location"] == {}
+
+
+def test_scrub_maps_admin_and_keeps_bot_commands(bot, admin_id):
+    scrubber = bot.UpdateScrubber("salt")
+    update = {"update_id": 1, "message": {"message_id": 1, "chat": {"id": admin_id}, "from": {"id": admin_id},
+                                           "text": "/search Іваненко"}}
+    msg = scrubber.scrub(update)["message"]
+    assert msg["from"]["id"] == "ADMIN"
+    assert msg["text"] == "/search " + "x" * len("Іваненко")
+
+    button = scrubber.scrub({"message": {"text": "✅ Готово"}})["message"]["text"]
+    assert button == "✅ Готово"
+    assert scrubber.scrub({"message": {"text": "/home/ivan"}})["message"]["text"] == "x" * len("/home/ivan")
+
+    call = scrubber.scrub({"callback_query": {"id": "99", "from": {"id": admin_id}, "data": "reply_777000111"}})
+    assert call["callback_query"]["data"] == f"reply_{scrubber.pseudonym(777000111)}"
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+
+
+def message(update_id, chat_id, text="hi"):
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'chat': {'id': chat_id}, 'text': text}}
+
+
+def test_full_queue_returns_503_and_allows_redelivery(bot, monkeypatch):
+    dispatcher = bot.UpdateDispatcher(lanes=1, max_queue=1)
+    monkeypatch.setattr(bot, "dispatcher", dispatcher)
+    started, release = threading.Event(), threading.Event()
+    processed = []
+
+    def blocking_process(update):
+        started.set()
+        release.wait(5)
+        processed.append(update['update_id'])
+
+    monkeypatch.setattr(bot, "process_update", blocking_process)
+    client = bot.app.test_client()
+
+    def post(update):
+        return client.post("/webhook", data=json.dumps(update), content_type="application/json").status_code
+
+    assert post(message(920001, 1)) == 200
+    assert started.wait(5)
+    assert post(message(920002, 2)) == 200  # ждёт в очереди
+    assert post(message(920003, 3)) == 503
+    suppressed = bot.dedup.suppressed
+
+    release.set()
+    assert dispatcher.wait_idle(5)
+    assert post(message(920003, 3)) == 200
+    assert dispatcher.wait_idle(5)
+    assert bot.dedup.suppressed == suppressed
+    assert processed == [920001, 920002, 920003]
+
+
+def record_processing(bot, monkeypatch, slow=()):
+    done = []
+    lock = threading.Lock()
+
+    def process(update):
+        if update['update_id'] in slow:
+            time.sleep(0.3)
+        with lock:
+            done.append((update['message']['chat']['id'], update['update_id']))
+
+    monkeypatch.setattr(bot, "process_update", process)
+    return done
+
+
+def test_chat_order_kept_and_chats_run_in_parallel(bot, monkeypatch):
+    dispatcher = bot.UpdateDispatcher(lanes=4)
+    done = record_processing(bot, monkeypatch, slow={921001})
+    for update_id, chat_id in [(921001, 1), (921002, 1), (921003, 2), (921004, 2)]:
+        assert dispatcher.submit(message(update_id, chat_id))
+    assert dispatcher.wait_idle(5)
+
+    assert [u for c, u in done if c == 1] == [921001, 921002]
+    assert [u for c, u in done if c == 2] == [921003, 921004]
+    assert done.index((2, 921004)) < done.index((1, 921001))
+
+
+def test_admin_lane_is_not_blocked_by_users(bot, monkeypatch, admin_id):
+    dispatcher = bot.UpdateDispatcher(lanes=1, priority=admin_id)
+    gate = threading.Event()
+    done = []
+
+    def process(update):
+        chat_id = update['message']['chat']['id']
+        if chat_id != admin_id:
+            gate.wait(5)
+        done.append(update['update_id'])
+
+    monkeypatch.setattr(bot, "process_update", process)
+    for update_id, chat_id in [(922001, 1), (922002, 2), (922003, admin_id)]:
+        assert dispatcher.submit(message(update_id, chat_id))
+
+    deadline = time.monotonic() + 5
+    while not done and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert done == [922003]  # единственная пользовательская очередь занята
+    gate.set()
+    assert dispatcher.wait_idle(5)
+    assert done == [922003, 922001, 922002]
+
+
+def test_redelivered_update_is_dropped(bot, monkeypatch):
+    dispatcher = bot.UpdateDispatcher(lanes=2)
+    monkeypatch.setattr(bot, "dispatcher", dispatcher)
+    done = record_processing(bot, monkeypatch)
+    client = bot.app.test_client()
+    suppressed = bot.dedup.suppressed
+    for _ in range(2):
+        resp = client.post("/webhook", data=json.dumps(message(923001, 5)), content_type="application/json")
+        assert resp.status_code == 200
+    assert dispatcher.wait_idle(5)
+    assert done == [(5, 923001)]
+    assert bot.dedup.suppressed == suppressed + 1
+
+
+def test_dedup_forgets_by_maxlen_and_ttl(bot):
+    dedup = bot.UpdateDeduplicator(maxlen=3, ttl=0.2)
+    assert [dedup.is_duplicate(i) for i in (1, 2, 3)] == [False] * 3
+    assert dedup.is_duplicate(3)
+    assert not dedup.is_duplicate(4)  # вытесняет 1
+    assert not dedup.is_duplicate(1)
+    assert dedup.suppressed == 1
+
+    time.sleep(0.3)
+    assert not dedup.is_duplicate(4)
+    assert len(dedup._seen) == len(dedup._ring) == 1
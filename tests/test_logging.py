@@ -0,0 +1,36 @@
+import os
+import time
+
+
+def gz_segments(tmp_path):
+    return sorted(n for n in os.listdir(tmp_path) if n.endswith('.gz'))
+
+
+def test_workers_share_one_rotation(bot, tmp_path):
+    path = str(tmp_path / "log.txt")
+    first = bot.AsyncLogWriter(path, rotate_interval=3600, backup_count=5)
+    second = bot.AsyncLogWriter(path, rotate_interval=3600, backup_count=5)
+    first._flush(["a\n"])
+    first._flush(["b\n"])  # создаёт log.txt.rotate
+    with open(path + ".rotate", "w") as f:
+        f.write(repr(time.time() - 7200))
+
+    second._flush(["c\n"])
+    first._flush(["d\n"])  # кэш первого устарел, но сегмент уже ротирован
+    assert len(gz_segments(tmp_path)) == 1
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == "c\nd\n"
+
+
+def test_failed_rotation_keeps_batch(bot, tmp_path):
+    path = str(tmp_path / "log.txt")
+    writer = bot.AsyncLogWriter(path, max_bytes=1)
+    writer._flush(["a\n"])
+
+    def rotate_lost_race():
+        raise FileNotFoundError(path)
+
+    writer._maybe_rotate = rotate_lost_race
+    writer._flush(["b\n"])
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == "a\nb\n"
@@ -0,0 +1,60 @@
+import os
+import threading
+import time
+
+import pytest
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="нужен fork")
+def test_outbox_restarts_after_fork(bot):
+    outbox = bot.Outbox(workers=2)
+    assert outbox.submit(1, lambda: None)
+    assert outbox.wait_idle(5)
+
+    read_fd, write_fd = os.pipe()
+    with outbox._lock:  # блокировка захвачена в момент fork, как у занятого потока родителя
+        pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            outbox.submit(1, os.write, write_fd, b"sent")
+            os._exit(0 if outbox.wait_idle(5) else 1)
+        finally:
+            os._exit(2)
+    os.close(write_fd)
+    _, status = os.waitpid(pid, 0)
+    assert os.read(read_fd, 16) == b"sent"
+    assert os.WEXITSTATUS(status) == 0
+
+
+def test_outbox_keeps_chat_order_and_runs_chats_in_parallel(bot):
+    outbox = bot.Outbox(workers=2)
+    done = []
+    lock = threading.Lock()
+
+    def job(chat_id, n, delay=0.0):
+        time.sleep(delay)
+        with lock:
+            done.append((chat_id, n))
+
+    outbox.submit(1, job, 1, 1, delay=0.3)
+    outbox.submit(1, job, 1, 2)
+    outbox.submit(2, job, 2, 1)
+    outbox.submit(2, job, 2, 2)
+    assert outbox.wait_idle(5)
+
+    assert [n for c, n in done if c == 1] == [1, 2]
+    assert [n for c, n in done if c == 2] == [1, 2]
+    assert done.index((2, 2)) < done.index((1, 1))
+
+
+def test_outbox_runs_admin_jobs_first(bot, admin_id):
+    outbox = bot.Outbox(workers=1, priority=admin_id)
+    gate = threading.Event()
+    done = []
+    outbox.submit(1, gate.wait, 5)
+    for chat_id in (2, 3, admin_id):
+        outbox.submit(chat_id, done.append, chat_id)
+    gate.set()
+    assert outbox.wait_idle(5)
+    assert done == [admin_id, 2, 3]
@@ -0,0 +1,44 @@
+import threading
+import time
+
+
+def test_offset_saved_after_batch_is_processed(bot, tmp_path, monkeypatch):
+    path = tmp_path / "poll_offset.txt"
+    monkeypatch.setattr(bot, "POLL_OFFSET_FILE", str(path))
+    processed = []
+    lock = threading.Lock()
+
+    def slow_process(update):
+        time.sleep(0.2)
+        with lock:
+            processed.append(update['update_id'])
+
+    monkeypatch.setattr(bot, "process_update", slow_process)
+    updates = [{'update_id': 910000 + i, 'message': {'message_id': i, 'chat': {'id': 7000 + i}, 'text': 'hi'}}
+               for i in range(3)]
+
+    assert bot._dispatch_poll_batch(updates) == 910003
+    assert sorted(processed) == [910000, 910001, 910002]
+    assert bot._load_poll_offset() == 910003
+
+
+def test_stuck_batch_does_not_stop_polling(bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "POLL_OFFSET_FILE", str(tmp_path / "poll_offset.txt"))
+    monkeypatch.setattr(bot, "POLL_BATCH_TIMEOUT", 0.2)
+    release = threading.Event()
+    monkeypatch.setattr(bot, "process_update", lambda update: release.wait(5))
+    alerts = []
+    monkeypatch.setattr(bot, "_alert_admin", alerts.append)
+    monkeypatch.setattr(bot, "ERROR_ALERT_ADMIN", True)
+    monkeypatch.setattr(bot.error_stats, "alert_allowed", lambda fp: True)
+
+    started = time.monotonic()
+    try:
+        update = {'update_id': 930000, 'message': {'message_id': 1, 'chat': {'id': 7100}, 'text': 'hi'}}
+        assert bot._dispatch_poll_batch([update]) == 930001
+    finally:
+        release.set()
+    assert time.monotonic() - started < 2
+    assert bot._load_poll_offset() == 930001
+    assert alerts and "930000" in alerts[0]
+    bot.dispatcher.wait_idle(5)
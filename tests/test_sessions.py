@@ -0,0 +1,137 @@
+import threading
+import time
+
+
+def photo(message_id, caption=None):
+    message = {'message_id': message_id, 'date': 1700000000,
+               'photo': [{'file_id': f'small-{message_id}'}, {'file_id': f'big-{message_id}'}]}
+    if caption:
+        message['caption'] = caption
+    return message
+
+
+def test_bytes_grow_by_item_size(bot):
+    store = bot.MemorySessionStore()
+    store.start_report(1, {'id': 1, 'first_name': 'Олена'})
+    before = store.stats()['bytes']
+    assert before > 0
+
+    message = photo(1, "дим над дахом")
+    assert store.add_item(1, message) is True
+    item_size = bot.ReportItem.from_message(message).nbytes()
+    assert store.stats() == {'sessions': 1, 'items': 1, 'bytes': before + item_size}
+
+    store.pop_report(1)
+    assert store.stats() == {'sessions': 0, 'items': 0, 'bytes': 0}
+
+
+def test_report_max_items(bot):
+    store = bot.MemorySessionStore(max_items=3)
+    store.start_report(1, {'id': 1})
+    assert [store.add_item(1, photo(i)) for i in range(4)] == [True, True, True, False]
+    assert store.add_item(2, photo(1)) is None
+    assert len(store.pop_report(1).items) == 3
+
+
+def test_lru_eviction_over_budget(bot):
+    probe = bot.MemorySessionStore()
+    probe.start_report(0, {'id': 0})
+    probe.add_item(0, photo(0))
+    per_session = probe.stats()['bytes']
+
+    store = bot.MemorySessionStore()
+    for chat_id in (1, 2):
+        store.start_report(chat_id, {'id': chat_id})
+        store.add_item(chat_id, photo(chat_id))
+    store.add_item(1, photo(10))  # чат 1 тронут последним — вытеснять надо чат 2
+    store.memory_budget = store.stats()['bytes'] + per_session - 1
+    store.start_report(3, {'id': 3})
+    store.add_item(3, photo(3))
+
+    assert store.evicted == 1
+    assert not store.has_report(2)
+    assert store.has_report(1) and store.has_report(3)
+    assert store.stats()['bytes'] <= store.memory_budget
+
+
+def test_budget_keeps_current_session(bot):
+    store = bot.MemorySessionStore(memory_budget=1)
+    store.start_report(1, {'id': 1})
+    assert store.add_item(1, photo(1)) is True
+    assert store.has_report(1) and store.evicted == 0
+
+
+def test_expire_removes_stale_sessions(bot):
+    store = bot.MemorySessionStore(ttl=60)
+    for chat_id in (1, 2):
+        store.start_report(chat_id, {'id': chat_id})
+        store.add_item(chat_id, photo(chat_id))
+    store.user_messages[1].touched = time.time() - 120
+
+    assert store.expire() == 1
+    assert not store.has_report(1) and store.has_report(2)
+    assert store.stats()['bytes'] == store.user_messages[2].nbytes
+
+
+def test_sqlite_item_visible_to_other_worker(bot, tmp_path):
+    path = str(tmp_path / "sessions.db")
+    first, second = bot.SQLiteSessionStore(path=path), bot.SQLiteSessionStore(path=path)
+    first.start_report(1, {'id': 1})
+    assert first.add_item(1, photo(1, "дим")) is True
+    assert first.add_item(2, photo(2)) is None
+
+    report = second.pop_report(1)
+    assert [item.caption for item in report.items] == ["дим"]
+    assert first.add_item(1, photo(3)) is None
+
+
+def test_sqlite_concurrent_adds_are_all_committed(bot, tmp_path):
+    store = bot.SQLiteSessionStore(path=str(tmp_path / "sessions.db"), max_items=30)
+    store.start_report(1, {'id': 1})
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(store.add_item(1, photo(i)))) for i in range(40)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results, key=str) == [False] * 10 + [True] * 30
+    assert len(bot.SQLiteSessionStore(path=store.path).pop_report(1).items) == 30
+
+
+def test_lost_report_is_reported_once(bot, monkeypatch):
+    store = bot.MemorySessionStore(memory_budget=1)
+    monkeypatch.setattr(bot, "sessions", store)
+    sent = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, **kw: sent.append((chat_id, text)))
+    store.start_report(1, {'id': 1})
+    store.add_item(1, photo(1))
+    store.start_report(2, {'id': 2})  # чат 1 вытеснен
+    assert store.evicted == 1
+
+    bot.handle_collect(photo(2), 1, 1)
+    bot.handle_collect(photo(3), 1, 1)  # повторно не напоминаем
+    bot.handle_report_done({}, 1, 1)
+    bot.outbox.wait_idle(5)
+    assert sent == [(1, bot.REPORT_LOST_TEXT)] * 2
+
+    bot.handle_report_done({}, 1, 1)
+    bot.outbox.wait_idle(5)
+    assert "Дякуємо" in sent[-1][1]
+
+
+def test_expired_reports_are_marked_lost(bot, tmp_path):
+    memory = bot.MemorySessionStore(ttl=60)
+    sqlite = bot.SQLiteSessionStore(path=str(tmp_path / "sessions.db"), ttl=60)
+    for store in (memory, sqlite):
+        store.start_report(1, {'id': 1})
+        store.start_report(2, {'id': 2})
+    memory.user_messages[1].touched = time.time() - 120
+    sqlite._connect().execute("UPDATE report_sessions SET updated = ? WHERE chat_id = 1", (time.time() - 120,))
+
+    for store in (memory, sqlite):
+        assert store.expire() == 1
+        assert store.is_lost(1) and store.is_lost(1)
+        assert store.pop_lost(1) and not store.is_lost(1)
+        assert not store.pop_lost(2)
+        store.start_report(1, {'id': 1})
+        assert not store.pop_lost(1)
@@ -0,0 +1,68 @@
+import threading
+import time
+
+
+def run_job(watchdog, deadline, body):
+    done = threading.Event()
+
+    def job():
+        token = watchdog.begin("job", deadline)
+        try:
+            body()
+        finally:
+            watchdog.end(token)
+            done.set()
+
+    threading.Thread(target=job, daemon=True).start()
+    return done
+
+
+def test_rate_limit_waits_do_not_count_as_stall(bot):
+    watchdog = bot.StallWatchdog(interval=0.05, unhealthy_after=0.2)
+
+    def body():
+        with watchdog.waiting():
+            time.sleep(0.6)
+
+    done = run_job(watchdog, 0.1, body)
+    time.sleep(0.5)
+    assert watchdog.healthy()
+    assert watchdog.oldest() < 0.1
+    done.wait(2)
+    assert watchdog.stalls == 0
+
+
+def test_busy_job_stalls_then_recovers(bot):
+    watchdog = bot.StallWatchdog(interval=0.05, unhealthy_after=0.2)
+    done = run_job(watchdog, 0.1, lambda: time.sleep(0.6))
+    time.sleep(0.2)
+    assert watchdog.stalls == 1
+    assert watchdog.healthy()  # дедлайн превышен, но меньше чем на unhealthy_after
+    time.sleep(0.2)
+    assert not watchdog.healthy()
+    done.wait(2)
+    assert watchdog.healthy()
+    assert watchdog.inflight() == 0
+
+
+def test_health_uses_each_entry_deadline(bot):
+    watchdog = bot.StallWatchdog(interval=0.05, unhealthy_after=0.1)
+    done = run_job(watchdog, 1.0, lambda: time.sleep(0.5))
+    time.sleep(0.3)
+    assert watchdog.healthy()  # долго для unhealthy_after, но в пределах собственного дедлайна
+    done.wait(2)
+
+
+def test_retry_after_sleep_is_excluded(bot, api, monkeypatch):
+    monkeypatch.setattr(bot, "RATE_MAX_RETRIES", 1)
+    monkeypatch.setattr(api, "rate_429", 1.0)
+    monkeypatch.setattr(api, "retry_after", 1)
+    token = bot.watchdog.begin("api", 0.5)
+    try:
+        started = time.monotonic()
+        bot.tg.call("getMe")
+        assert time.monotonic() - started >= 1.0
+        entry = bot.watchdog._inflight[token]
+        assert bot.watchdog._active(entry, time.monotonic()) < 0.5
+    finally:
+        bot.watchdog.end(token)
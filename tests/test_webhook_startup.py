@@ -0,0 +1,77 @@
+# Старт процесса бота: сверка webhook один раз на деплой и время до первого /webhook.
+# Каждый запуск — отдельный процесс, потому что bot.py выполняет настройку при импорте.
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOOT_SCRIPT = r"""
+import json, os, sys, threading, time
+sys.path.insert(0, os.path.join(REPO, "tools"))
+sys.path.insert(0, REPO)
+from fake_bot_api import FakeBotAPI
+api = FakeBotAPI().start()
+os.environ["TELEGRAM_API_BASE"] = api.base_url
+import bot
+for t in threading.enumerate():
+    if t.name == "webhook-setup":
+        t.join(10)
+client = bot.app.test_client()
+update = {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 5}, "from": {"id": 5}, "text": "/start"}}
+status = client.post("/webhook", data=json.dumps(update), content_type="application/json").status_code
+print(json.dumps({"status": status, "startup": bot.startup_seconds, "cold_start": bot.cold_start_seconds,
+                  "calls": dict(api.calls), "marker": bot._webhook_marker_path()}))
+"""
+
+
+def boot(tmp_path, **env):
+    full_env = dict(os.environ, API_TOKEN="test:token", ADMIN_ID="1000", BOT_MODE="webhook",
+                    WEBHOOK_HOST="https://bot.example.test", WEBHOOK_STATE_DIR=str(tmp_path), REPO=REPO_DIR)
+    full_env.update(env)
+    out = subprocess.run([sys.executable, "-c", "REPO = __import__('os').environ['REPO']\n" + BOOT_SCRIPT],
+                         cwd=str(tmp_path), env=full_env, capture_output=True, text=True, timeout=60)
+    assert out.returncode == 0, out.stderr
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_cold_start_is_measured_and_fast(tmp_path):
+    result = boot(tmp_path, DEPLOY_ID="d1")
+    assert result["status"] == 200
+    assert result["startup"] < 1.0
+    assert result["cold_start"] is not None and result["cold_start"] < 2.0
+
+
+def test_webhook_reconciled_once_per_deploy(tmp_path):
+    first = boot(tmp_path, DEPLOY_ID="d1")
+    assert first["calls"].get("getWebhookInfo") == 1
+    assert first["calls"].get("setWebhook") == 1
+    assert "deleteWebhook" not in first["calls"]
+
+    # Второй воркер того же деплоя сверку пропускает
+    second = boot(tmp_path, DEPLOY_ID="d1")
+    assert "getWebhookInfo" not in second["calls"]
+
+    # Новый деплой сверяет заново
+    third = boot(tmp_path, DEPLOY_ID="d2")
+    assert third["calls"].get("getWebhookInfo") == 1
+
+
+def test_stale_marker_is_reconciled(tmp_path):
+    first = boot(tmp_path, DEPLOY_ID="d1")
+    old = time.time() - 3600
+    os.utime(first["marker"], (old, old))
+    again = boot(tmp_path, DEPLOY_ID="d1", WEBHOOK_MARKER_TTL="600")
+    assert again["calls"].get("getWebhookInfo") == 1
+
+
+def test_polling_clears_markers(bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_STATE_DIR", str(tmp_path))
+    marker = bot._webhook_marker_path()
+    assert bot._claim_webhook_marker(marker)
+    assert not bot._claim_webhook_marker(marker)
+    bot.clear_webhook_markers()
+    assert not os.listdir(tmp_path)
+    assert bot._claim_webhook_marker(marker)
@@ -0,0 +1,214 @@
+# Офлайн-бенчмарк бота: Flask app + локальная заглушка Bot API
+#
+#   python tools/bench.py --scenario all --users 50 --media 10 --latency-ms 30
+#
+# Результаты сохраняются в bench_results/<время>.json для сравнения прогонов.
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+sys.path.insert(0, TOOLS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+ADMIN_ID = 1000
+SCENARIOS = ("start", "report", "admin_reply", "mixed")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class UpdateFactory:
+    """Генератор синтетических update в формате Telegram."""
+
+    def __init__(self):
+        self._update_id = 0
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    def _ids(self):
+        with self._lock:
+            self._update_id += 1
+            self._message_id += 1
+            return self._update_id, self._message_id
+
+    def message(self, chat_id, text=None, **fields):
+        update_id, message_id = self._ids()
+        msg = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "first_name": f"User{chat_id}", "username": f"user{chat_id}"},
+        }
+        if text is not None:
+            msg["text"] = text
+        msg.update(fields)
+        return {"update_id": update_id, "message": msg}
+
+    def photo(self, chat_id, caption=None, media_group_id=None):
+        fields = {"photo": [{"file_id": f"small-{chat_id}"}, {"file_id": f"large-{chat_id}"}]}
+        if caption:
+            fields["caption"] = caption
+        if media_group_id:
+            fields["media_group_id"] = media_group_id
+        return self.message(chat_id, **fields)
+
+    def callback(self, from_id, data):
+        update_id, _ = self._ids()
+        return {"update_id": update_id, "callback_query": {"id": str(update_id), "from": {"id": from_id}, "data": data}}
+
+
+def build_scenario(name, factory, users, media, base_chat):
+    """Возвращает список «сессий»: каждая — упорядоченный список update одного чата."""
+    sessions = []
+    chats = range(base_chat, base_chat + users)
+    if name in ("start", "mixed"):
+        for chat_id in chats:
+            sessions.append([factory.message(chat_id, "/start")])
+    if name in ("report", "mixed"):
+        for chat_id in chats:
+            seq = [factory.message(chat_id, "📝 Повідомити про подію"), factory.message(chat_id, "Що сталося")]
+            seq += [factory.photo(chat_id, caption=f"Фото {i}") for i in range(media)]
+            seq.append(factory.message(chat_id, "✅ Готово"))
+            sessions.append(seq)
+    if name in ("admin_reply", "mixed"):
+        seq = []
+        for chat_id in chats:
+            seq.append(factory.callback(ADMIN_ID, f"reply_{chat_id}"))
+            seq.append(factory.message(ADMIN_ID, f"Відповідь для {chat_id}"))
+        sessions.append(seq)
+    return sessions
+
+
+def run_scenario(bot, api, name, sessions, concurrency):
+    api.reset()
+    latencies = []
+    rejected = []
+    lock = threading.Lock()
+
+    def drive(seq):
+        client = bot.app.test_client()
+        local = []
+        local_rejected = 0
+        for update in seq:
+            body = json.dumps(update)
+            t0 = time.perf_counter()
+            resp = client.post("/webhook", data=body, content_type="application/json")
+            local.append(time.perf_counter() - t0)
+            assert resp.status_code in (200, 503), resp.status_code
+            if resp.status_code == 503:
+                local_rejected += 1
+        with lock:
+            latencies.extend(local)
+            rejected.append(local_rejected)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(drive, sessions))
+    accepted = time.perf_counter() - started
+    bot.dispatcher.wait_idle(300)
+    bot.outbox.wait_idle(300)
+    elapsed = time.perf_counter() - started
+
+    updates = len(latencies)
+    outbound = api.total_calls()
+    return {
+        "updates": updates,
+        "elapsed_s": round(elapsed, 4),
+        "accept_s": round(accepted, 4),
+        "updates_per_s": round(updates / elapsed, 2) if elapsed else 0.0,
+        "webhook_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+        },
+        "outbound_calls": outbound,
+        "outbound_per_update": round(outbound / updates, 3) if updates else 0.0,
+        "outbound_by_method": dict(api.calls),
+        "outbound_statuses": {str(k): v for k, v in api.statuses.items()},
+        "rejected_503": sum(rejected),
+    }
+
+
+def load_bot(api, rate_limits):
+    """Импортирует bot.py, направив его на заглушку и во временный каталог для логов."""
+    os.environ.setdefault("API_TOKEN", "bench:token")
+    os.environ["ADMIN_ID"] = str(ADMIN_ID)
+    os.environ["WEBHOOK_HOST"] = ""
+    os.environ["BOT_MODE"] = "webhook"
+    os.environ["TELEGRAM_API_BASE"] = api.base_url
+    if not rate_limits:
+        os.environ.setdefault("RATE_GLOBAL_PER_SEC", "1000000")
+        os.environ.setdefault("RATE_CHAT_PER_SEC", "1000000")
+        os.environ.setdefault("RATE_CHAT_BURST", "1000000")
+        os.environ.setdefault("RATE_GROUP_PER_MIN", "1000000")
+    # Защита от флуда и сброс нагрузки исказили бы пропускную способность
+    os.environ.setdefault("FLOOD_RATE_PER_MIN", "0")
+    os.environ.setdefault("SHED_QUEUE_DEPTH", "0")
+    os.environ.setdefault("SHED_QUEUE_WAIT", "0")
+    os.chdir(tempfile.mkdtemp(prefix="bot-bench-"))
+    import bot
+    return bot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--users", type=int, default=20, help="число пользователей в сценарии")
+    parser.add_argument("--media", type=int, default=10, help="медиа в одном отчёте")
+    parser.add_argument("--concurrency", type=int, default=8, help="параллельных клиентов webhook")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="задержка заглушки Bot API")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--rate-limits", action="store_true", help="оставить реальные лимиты Telegram")
+    parser.add_argument("--out", default=os.path.join(REPO_DIR, "bench_results"), help="каталог для JSON")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency_ms / 1000.0, rate_429=args.rate_429,
+                     error_rate=args.error_rate, retry_after=1).start()
+    out_dir = os.path.abspath(args.out)
+    bot = load_bot(api, args.rate_limits)
+
+    factory = UpdateFactory()
+    names = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    results = {}
+    for i, name in enumerate(names):
+        sessions = build_scenario(name, factory, args.users, args.media, base_chat=10000 * (i + 1))
+        results[name] = run_scenario(bot, api, name, sessions, args.concurrency)
+        r = results[name]
+        print(f"{name:12s} updates={r['updates']:5d}  {r['updates_per_s']:8.1f} upd/s  "
+              f"webhook p50={r['webhook_ms']['p50']:.2f}ms p95={r['webhook_ms']['p95']:.2f}ms "
+              f"p99={r['webhook_ms']['p99']:.2f}ms  outbound={r['outbound_calls']} "
+              f"({r['outbound_per_update']}/upd)")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "connections": bot.tg.connection_stats(),
+        "scenarios": results,
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, time.strftime("bench-%Y%m%d-%H%M%S.json"))
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[INFO] Результати: {path}")
+    api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# Локальная заглушка Telegram Bot API для бенчмарков
+import json
+import random
+import threading
+import time
+import argparse
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+
+class FakeBotAPI:
+    """Имитирует api.telegram.org: /bot<TOKEN>/<method>.
+
+    latency       — задержка ответа, сек
+    rate_429      — доля ответов 429 с parameters.retry_after
+    error_rate    — доля ответов 500
+    retry_after   — значение retry_after в ответах 429
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, rate_429=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.statuses = Counter()
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-bot-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.statuses.clear()
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _result(self, method, params):
+        if method == "getWebhookInfo":
+            return {"url": "", "pending_update_count": 0}
+        if method == "getUpdates":
+            return []
+        if method in ("copyMessages", "forwardMessages"):
+            ids = json.loads(params.get("message_ids", "[]"))
+            return [{"message_id": self._next_message_id()} for _ in ids]
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return [{"message_id": self._next_message_id()} for _ in media]
+        if method.startswith(("send", "copy", "forward", "edit")) and method != "sendChatAction":
+            return {
+                "message_id": self._next_message_id(),
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id")},
+            }
+        return True
+
+    def _respond(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        roll = random.random()
+        if roll < self.rate_429:
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        if roll < self.rate_429 + self.error_rate:
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+        return 200, {"ok": True, "result": self._result(method, params)}
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode("utf-8") if length else ""
+                params = {k: v[0] for k, v in parse_qs(body).items()}
+                method = self.path.rsplit("/", 1)[-1].split("?", 1)[0]
+                status, payload = api._respond(method, params)
+                with api._lock:
+                    api.calls[method] += 1
+                    api.statuses[status] += 1
+                out = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            do_POST = _handle
+            do_GET = _handle
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    api = FakeBotAPI(port=args.port, latency=args.latency_ms / 1000.0, rate_429=args.rate_429,
+                     error_rate=args.error_rate, retry_after=args.retry_after).start()
+    print(f"[INFO] Fake Bot API: {api.base_url}  (TELEGRAM_API_BASE={api.base_url})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# Воспроизведение записанного трафика (CAPTURE_FILE) против бота и заглушки Bot API
+#
+#   python tools/replay.py capture.jsonl capture.jsonl.*.gz --speed 10 --latency-ms 30
+#
+# --speed 1 — в реальном времени, N — в N раз быстрее, max — без пауз.
+# Обновления одного чата отправляются по порядку, интервалы между ними сохраняются.
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import threading
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+sys.path.insert(0, TOOLS_DIR)
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from bench import ADMIN_ID, percentile, load_bot  # noqa: E402
+
+ADMIN_MARKER = "ADMIN"
+
+
+def read_capture(paths):
+    """Читает записи {"t", "update"} из JSONL (и ротированных .gz), сортирует по времени."""
+    records = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    records.append((record["t"], record["update"]))
+    records.sort(key=lambda r: r[0])
+    return records
+
+
+def restore_admin(value):
+    """Маркер ADMIN -> ADMIN_ID бенчмарка (в id и в callback_data «reply_ADMIN»)."""
+    if isinstance(value, list):
+        return [restore_admin(v) for v in value]
+    if isinstance(value, dict):
+        return {k: restore_admin(v) for k, v in value.items()}
+    if value == ADMIN_MARKER:
+        return ADMIN_ID
+    if isinstance(value, str) and value.endswith("_" + ADMIN_MARKER):
+        return value[:-len(ADMIN_MARKER)] + str(ADMIN_ID)
+    return value
+
+
+def update_chat(update):
+    if "callback_query" in update:
+        return (update["callback_query"].get("from") or {}).get("id")
+    message = update.get("message") or {}
+    return (message.get("chat") or {}).get("id")
+
+
+def build_lanes(records, lanes, speed):
+    """Раскладывает обновления по потокам по чату: [(смещение от старта, update), ...]."""
+    out = [[] for _ in range(lanes)]
+    if not records:
+        return out
+    t0 = records[0][0]
+    for t, update in records:
+        offset = 0.0 if speed is None else (t - t0) / speed
+        out[hash(update_chat(update)) % lanes].append((offset, restore_admin(update)))
+    return out
+
+
+def replay(bot, api, lanes):
+    api.reset()
+    latencies = []
+    lags = []
+    rejected = []
+    lock = threading.Lock()
+    started = time.perf_counter()
+
+    def drive(seq):
+        client = bot.app.test_client()
+        local_lat, local_lag = [], []
+        local_rejected = 0
+        for offset, update in seq:
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                local_lag.append(-delay)
+            body = json.dumps(update)
+            t0 = time.perf_counter()
+            resp = client.post("/webhook", data=body, content_type="application/json")
+            local_lat.append(time.perf_counter() - t0)
+            assert resp.status_code in (200, 503), resp.status_code
+            if resp.status_code == 503:
+                local_rejected += 1
+        with lock:
+            latencies.extend(local_lat)
+            lags.extend(local_lag)
+            rejected.append(local_rejected)
+
+    threads = [threading.Thread(target=drive, args=(seq,)) for seq in lanes if seq]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    accepted = time.perf_counter() - started
+    bot.dispatcher.wait_idle(600)
+    bot.outbox.wait_idle(600)
+    elapsed = time.perf_counter() - started
+
+    updates = len(latencies)
+    outbound = api.total_calls()
+    return {
+        "updates": updates,
+        "elapsed_s": round(elapsed, 4),
+        "accept_s": round(accepted, 4),
+        "updates_per_s": round(updates / elapsed, 2) if elapsed else 0.0,
+        "webhook_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+        },
+        "schedule_lag_ms": {
+            "late_updates": len(lags),
+            "p99": round(percentile(lags, 99) * 1000, 3),
+        },
+        "outbound_calls": outbound,
+        "outbound_per_update": round(outbound / updates, 3) if updates else 0.0,
+        "outbound_by_method": dict(api.calls),
+        "outbound_statuses": {str(k): v for k, v in api.statuses.items()},
+        "rejected_503": sum(rejected),
+        "shed": bot.admission.shed,
+        "flood_limited": bot.flood.limited,
+        "duplicates": bot.dedup.suppressed,
+    }
+
+
+def parse_speed(value):
+    if value == "max":
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed має бути > 0 або max")
+    return speed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Відтворення записаного трафіку бота")
+    parser.add_argument("files", nargs="+", help="файли CAPTURE_FILE (.jsonl або ротовані .gz)")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="1, N (у N разів швидше) або max")
+    parser.add_argument("--lanes", type=int, default=16, help="паралельних відправників (чати не змішуються)")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="задержка заглушки Bot API")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--rate-limits", action="store_true", help="оставить реальные лимиты Telegram")
+    parser.add_argument("--out", default=os.path.join(REPO_DIR, "bench_results"), help="каталог для JSON")
+    args = parser.parse_args()
+
+    files = [os.path.abspath(p) for p in args.files]
+    records = read_capture(files)
+    if not records:
+        print("[WARN] Запис порожній")
+        return
+    span = records[-1][0] - records[0][0]
+    print(f"[INFO] {len(records)} оновлень за {span:.1f} с запису")
+
+    api = FakeBotAPI(latency=args.latency_ms / 1000.0, rate_429=args.rate_429,
+                     error_rate=args.error_rate, retry_after=1).start()
+    out_dir = os.path.abspath(args.out)
+    bot = load_bot(api, args.rate_limits)
+
+    r = replay(bot, api, build_lanes(records, args.lanes, args.speed))
+    print(f"replay       updates={r['updates']:5d}  {r['updates_per_s']:8.1f} upd/s  "
+          f"webhook p50={r['webhook_ms']['p50']:.2f}ms p95={r['webhook_ms']['p95']:.2f}ms "
+          f"p99={r['webhook_ms']['p99']:.2f}ms  outbound={r['outbound_calls']} "
+          f"({r['outbound_per_update']}/upd)  lag p99={r['schedule_lag_ms']['p99']:.1f}ms")
+
+    config = vars(args)
+    config["speed"] = "max" if args.speed is None else args.speed
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": config,
+        "capture_span_s": round(span, 3),
+        "connections": bot.tg.connection_stats(),
+        "replay": r,
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, time.strftime("replay-%Y%m%d-%H%M%S.json"))
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[INFO] Результати: {path}")
+    api.stop()
+
+
+if __name__ == "__main__":
+    main()